@@ -0,0 +1,297 @@
+"""Benchmarks of the correlator stages over synthetic traces.
+
+Generates a trace per technology and size (see ``correlator.synthetic``),
+then times parsing, correlation, scenario classification and L3 decoding
+with the stand-in decoder, one after the other, each in a fresh process
+streaming the trace. Prints a JSON report, messages per second and peak
+RSS by stage, which ``--compare`` sets against the report of an earlier
+commit.
+
+    python bench.py --size-mb 10 100 -g 4G 3G --out bench.json
+    python bench.py --size-mb 10 --compare bench.json
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing as mp
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from correlator.classes import (XDR3G, XDR4G, DayClock, Message3G, Message4G,
+                                XDR_scenario)
+from correlator.columns import MessageColumns
+from correlator.engine import Correlator
+from correlator.l3 import L3Decoder
+from correlator.metrics import peak_rss_mb
+from correlator.synthetic import Profile, write_trace
+from correlator.vector import correlate_columns, np
+from decoded_corr import REORDER_WINDOW, read_messages
+
+STUB_DECODER = (
+    sys.executable,
+    str(pathlib.Path(__file__).parent / "correlator" / "stub_tshark.py"),
+    "{dlt}",
+)
+TECHS = {"4G": (Message4G, XDR4G), "3G": (Message3G, XDR3G)}
+# messages parsed at a time, out of the stage timings
+BATCH = 10000
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=pathlib.Path(__file__).parent,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Stages:
+    """Time, item count and peak RSS of each stage, by stage name.
+
+    Each stage runs in a process of its own, started afresh, so that its
+    peak RSS is not the one of the stages before it. The benchmark process
+    only writes traces, streamed to disk, and stays small.
+    """
+
+    def __init__(self):
+        self.result = {}
+
+    def run(self, name: str, func, *args) -> int:
+        """Calls ``func``, which returns the number of items and the seconds
+        spent on them; returns the number of items."""
+        with concurrent.futures.ProcessPoolExecutor(
+            1, mp_context=mp.get_context("spawn")
+        ) as executor:
+            items, seconds, peak_rss = executor.submit(measured, func, *args).result()
+        self.result[name] = {
+            "seconds": round(seconds, 4),
+            "items": items,
+            "items_per_sec": round(items / seconds, 1) if seconds else None,
+            "peak_rss_mb": round(peak_rss, 1),
+        }
+        return items
+
+
+def measured(func, *args):
+    items, seconds = func(*args)
+    return items, seconds, peak_rss_mb()
+
+
+def read(path, Message_, mapped):
+    """Messages of the trace, streamed, 4G times moved past midnight."""
+    clock = DayClock() if Message_.time_of_day else None
+    for msg in read_messages(path, Message_, l3=True, mapped=mapped):
+        if clock is not None:
+            msg.ts = clock(msg.ts)
+        yield msg
+
+
+def batches(items, size: int = BATCH):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def closed_xdrs(path, Message_, XDR_, mapped):
+    """Batches of the XDRs of the trace, as the correlator closes them when
+    streaming."""
+    correlator = Correlator(XDR_, REORDER_WINDOW)
+    for msgs in batches(read(path, Message_, mapped)):
+        for msg in msgs:
+            correlator.add(msg)
+        yield correlator.drain()
+    yield correlator.flush()
+
+
+def parse(path, tech, mapped):
+    ts_start = time.perf_counter()
+    items = sum(1 for _ in read(path, TECHS[tech][0], mapped))
+    return items, time.perf_counter() - ts_start
+
+
+def correlate(path, tech, mapped):
+    Message_, XDR_ = TECHS[tech]
+    correlator = Correlator(XDR_, REORDER_WINDOW)
+    items = 0
+    seconds = 0
+    for msgs in batches(read(path, Message_, mapped)):
+        ts_start = time.perf_counter()
+        for msg in msgs:
+            correlator.add(msg)
+        correlator.drain()
+        seconds += time.perf_counter() - ts_start
+        items += len(msgs)
+    ts_start = time.perf_counter()
+    correlator.flush()
+    return items, seconds + time.perf_counter() - ts_start
+
+
+def correlate_numpy(path, tech, mapped):
+    # one shard of the batch mode, built from the messages as they come
+    Message_, XDR_ = TECHS[tech]
+    columns = MessageColumns(Message_)
+    seconds = 0
+    for msgs in batches(read(path, Message_, mapped)):
+        ts_start = time.perf_counter()
+        for msg in msgs:
+            columns.append(msg)
+        seconds += time.perf_counter() - ts_start
+    ts_start = time.perf_counter()
+    correlate_columns(XDR_, columns)
+    return len(columns), seconds + time.perf_counter() - ts_start
+
+
+def classify(path, tech, mapped, scenarios_path):
+    scenarios = XDR_scenario(scenarios_path)
+    items = 0
+    seconds = 0
+    for xdrs in closed_xdrs(path, *TECHS[tech], mapped):
+        ts_start = time.perf_counter()
+        for xdr in xdrs:
+            scenarios.scenario_nb(xdr.get_msg_descr())
+        seconds += time.perf_counter() - ts_start
+        items += len(xdrs)
+    return items, seconds
+
+
+def decode(path, tech, mapped, procs):
+    items = 0
+    seconds = 0
+    with L3Decoder({}, procs_per_dlt=procs, command=STUB_DECODER) as decoder:
+        for xdrs in closed_xdrs(path, *TECHS[tech], mapped):
+            ts_start = time.perf_counter()
+            msgs = [msg for xdr in xdrs for msg in xdr.messages]
+            metas = iter(decoder.decode(msgs))
+            for xdr in xdrs:
+                for msg in xdr.messages:
+                    meta = next(metas)
+                    if meta is not None:
+                        xdr.extract_meta(msg.name, meta)
+            seconds += time.perf_counter() - ts_start
+            items += len(msgs)
+    return items, seconds
+
+
+def bench(tech: str, size_mb: float, parsed, work_dir: pathlib.Path) -> dict:
+    path = work_dir / f"trace_{tech}_{size_mb}mb.txt"
+    ts_start = time.perf_counter()
+    with open(path, "w") as file_hnd:
+        write_trace(file_hnd, int(size_mb * 2 ** 20), tech, Profile(seed=parsed.seed))
+    generate_time = time.perf_counter() - ts_start
+    stages = Stages()
+    msgs = stages.run("parse", parse, path, tech, parsed.mmap)
+    stages.run("correlate", correlate, path, tech, parsed.mmap)
+    if np is not None and not parsed.no_numpy:
+        stages.run("correlate_numpy", correlate_numpy, path, tech, parsed.mmap)
+    xdrs = stages.run(
+        "scenarios", classify, path, tech, parsed.mmap, work_dir / f"scenarios_{tech}"
+    )
+    if not parsed.no_l3:
+        stages.run("l3", decode, path, tech, parsed.mmap, parsed.l3_procs)
+    return {
+        "tech": tech,
+        "size_mb": size_mb,
+        "bytes": path.stat().st_size,
+        "messages": msgs,
+        "xdrs": xdrs,
+        "generate_seconds": round(generate_time, 4),
+        "stages": stages.result,
+    }
+
+
+def compare(report: dict, baseline: dict):
+    """Prints each stage's speed against the baseline report, on stderr."""
+    runs = {(run["tech"], run["size_mb"]): run for run in baseline["runs"]}
+    for run in report["runs"]:
+        old = runs.get((run["tech"], run["size_mb"]))
+        if old is None:
+            continue
+        for stage, result in run["stages"].items():
+            old_result = old["stages"].get(stage)
+            if not old_result or not old_result["items_per_sec"]:
+                continue
+            ratio = result["items_per_sec"] / old_result["items_per_sec"]
+            print(
+                f"{run['tech']} {run['size_mb']}MB {stage:>16}: {ratio:.2f}x"
+                f"\t{old_result['items_per_sec']:.0f} -> "
+                f"{result['items_per_sec']:.0f} items/s",
+                file=sys.stderr,
+            )
+
+
+def parse_arguments(args):
+    parser = argparse.ArgumentParser(description="benchmark the correlator stages")
+    parser.add_argument(
+        "--size-mb", dest="size_mb", type=float, nargs="+", default=[10]
+    )
+    parser.add_argument(
+        "-g", dest="tech", nargs="+", choices=tuple(TECHS), default=["4G", "3G"]
+    )
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parser.add_argument(
+        "--mmap", dest="mmap", action="store_true", help="parse mapped traces"
+    )
+    parser.add_argument("--no-l3", dest="no_l3", action="store_true")
+    parser.add_argument("--no-numpy", dest="no_numpy", action="store_true")
+    parser.add_argument(
+        "--l3-procs",
+        dest="l3_procs",
+        type=int,
+        default=2,
+        help="stand-in decoder processes",
+    )
+    parser.add_argument(
+        "--dir",
+        dest="dir",
+        action="store",
+        help="where traces are written, a temporary directory by default",
+    )
+    parser.add_argument("--out", dest="out", action="store", help="JSON report file")
+    parser.add_argument(
+        "--compare",
+        dest="compare",
+        action="store",
+        help="JSON report of an earlier run to compare with",
+    )
+    return parser.parse_args(args)
+
+
+def main(args):
+    parsed = parse_arguments(args)
+    report = {
+        "commit": commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__ if np is not None else None,
+        "runs": [],
+    }
+    with tempfile.TemporaryDirectory(dir=parsed.dir) as work_dir:
+        for tech in parsed.tech:
+            for size_mb in parsed.size_mb:
+                print(f"{tech} {size_mb}MB", file=sys.stderr)
+                report["runs"].append(
+                    bench(tech, size_mb, parsed, pathlib.Path(work_dir))
+                )
+    text = json.dumps(report, indent=2)
+    if parsed.out:
+        pathlib.Path(parsed.out).write_text(text + "\n")
+    print(text)
+    if parsed.compare:
+        compare(report, json.loads(pathlib.Path(parsed.compare).read_text()))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,40 +1,142 @@
 import csv
-import itertools
+import functools
+import hashlib
+import io
 import pathlib
 import re
 import sys
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from typing import Dict, List
 
-__all__ = ["XDR3G", "XDR4G", "Message4G", "Message3G"]
+try:
+    import fcntl
+except ImportError:  # no locking where flock is not available
+    fcntl = None
+
+__all__ = ["XDR3G", "XDR4G", "Message4G", "Message3G", "DayClock"]
 NULL_ENB = 8388608
 NULL_MME = 2147483648
+DAY_MS = 86400000
+FP_SIZE = 16
+
+
+@functools.lru_cache(maxsize=64)
+def epoch_day_ms(day: str) -> int:
+    # YYYY-MM-DD
+    return (
+        date(int(day[0:4]), int(day[5:7]), int(day[8:10])).toordinal()
+        - date(1970, 1, 1).toordinal()
+    ) * DAY_MS
+
+
+def time_of_day_ms(ts: str) -> int:
+    # HH:MM:SS[.fff]
+    result = (
+        int(ts[0:2]) * 3600000 + int(ts[3:5]) * 60000 + int(ts[6:8]) * 1000
+    )
+    if len(ts) > 9:
+        result += int(ts[9:12].ljust(3, "0"))
+    return result
+
+
+def fingerprint(body: str) -> bytes:
+    # the part of the body messages compare on, past the header
+    return hashlib.blake2b(body[50:].encode(), digest_size=FP_SIZE).digest()
+
+
+@functools.lru_cache(maxsize=None)
+def meta_matcher(xdr_class, name: str):
+    """One regexp for all ``extract_rules`` of messages called ``name``.
+
+    It matches the lines holding one of the wanted field names, in the group
+    named after the meta field, and captures their ``value`` attribute.
+    """
+    alternatives = [
+        f"(?P<{meta_id}>{'|'.join(re.escape(tag) for tag in rules[name])})"
+        for meta_id, rules in xdr_class.extract_rules.items()
+        if name in rules
+    ]
+    if not alternatives:
+        return None
+    tags = "|".join(alternatives)
+    return re.compile(
+        rf'^(?=[^\n]*?(?:{tags}))[^\n]*?value="(?P<value>[^"]+)', re.MULTILINE
+    )
+
+
+class DayClock:
+    """Turns time-of-day stamps of one stream into a running count of ms.
+
+    A jump back by more than half a day is midnight, not reordering, and
+    starts the next day; a message still stamped before that midnight is
+    kept on the previous day.
+    """
 
-re_l3_value = re.compile(r'value="([^"]+)')
+    def __init__(self):
+        self.days = 0
+        self.last = None
 
-DATE_CACHE = {}
+    def __call__(self, ts: int) -> int:
+        if self.last is not None:
+            if self.last - ts > DAY_MS // 2:
+                self.days += 1
+            elif ts - self.last > DAY_MS // 2 and self.days:
+                return ts + (self.days - 1) * DAY_MS
+        self.last = ts
+        return ts + self.days * DAY_MS
 
 
 class Message:
+    __slots__ = (
+        "name",
+        "_timestamp",
+        "ts",
+        "text",
+        "source",
+        "span",
+        "_l3",
+        "meta",
+        "fp",
+    )
     key_fields = {}
+    key_field = None
+    # timestamps carry no date, see DayClock
+    time_of_day = False
+    # tag -> key field, see key_fields
+    tags = {}
     re_l3 = re.compile(r"\W+L3\[[^\]]+\]:\W([0-9a-f]+)")
+    # applied right after the colon of a key field line
+    re_value = None
     bounds = ("{", "}")
+    # header name and timestamp, which subclasses turn to ms with parse_ts()
     re_msg_nm = None
 
     def __init__(self):
         self.name = None
         self.timestamp = None
-        self.body = None
+        # timestamp in ms
+        self.ts = None
+        self.text = None
+        # body kept as a (start, end) span of a MappedFile instead of text
+        self.source = None
+        self.span = None
+        # timestamp text and L3 payload, as text or, with a span, as the
+        # (offset, length) of their bytes in the body, read when asked for
         self.l3 = None
-        self.re_keywords = {}
+        # decoded L3, None until the L3 stage decodes it, once
+        self.meta = None
+        # set with the body, see fingerprint()
+        self.fp = None
         for k in self.key_fields.keys():
             setattr(self, k, None)
-        self.key_field = list(self.key_fields.keys())[0]
 
-    # def __hash__(self):
-    #     return self.body.__hash__()
+    def __hash__(self):
+        return hash(self.fp)
 
     def __eq__(self, other):
-        return self.body[50:] == other.body[50:]
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.fp == other.fp
 
     def __str__(self):
         result = f"{self.name:>45} @ {self.timestamp}: "
@@ -55,35 +157,155 @@ class Message:
     def __repr__(self):
         return self.__str__()
 
+    @property
+    def body(self):
+        if self.text is not None:
+            return self.text
+        if self.source is not None:
+            return self.source.text(*self.span)
+        return None
+
+    def _read(self, val):
+        if val.__class__ is tuple:
+            start = self.span[0] + val[0]
+            return self.source.text(start, start + val[1])
+        return val
+
+    @property
+    def timestamp(self) -> str:
+        return self._read(self._timestamp)
+
+    @timestamp.setter
+    def timestamp(self, val: str):
+        self._timestamp = val
+
+    @property
+    def l3(self) -> str:
+        """Hex L3 payload, None when not read or there is none."""
+        return None if self._l3 is None else self._read(self._l3)
+
+    @l3.setter
+    def l3(self, val: str):
+        self._l3 = val
+
+    @property
+    def has_l3(self) -> bool:
+        """Whether an L3 payload was read, without reading it out of a span."""
+        return self._l3 is not None
+
     def from_text(self, strings, l3=False):
-        body = False
+        """Reads lines up to the end of the next message.
+
+        Lines are split once on their first colon, the tag before it is
+        looked up in ``tags`` and only key field lines go through a regexp.
+        """
+        lines = None
         for line in strings:
             if self.bounds[0] in line:
                 mo = self.re_msg_nm.match(line)
                 if mo:
-                    body = True
-                    self.body = ""
-                    self.name = mo.group(1)
+                    lines = []
+                    # few distinct names, shared by all their messages
+                    self.name = sys.intern(mo.group(1))
                     self.timestamp = mo.group(2)
-            if body:
-                if self.bounds[1] in line:
-                    return self.cardinal_field_val is not None
-                self.body += line
-                for k, v in self.key_fields.items():
-                    mo = v["regexp"].search(line)
-                    if mo:
-                        val = int(mo.group(1))
-                        if k in ("enbid", "trsr") and val == NULL_ENB:
-                            continue
-                        setattr(self, k, val)
-                if (l3) and "L3" in line:
-                    mo = self.re_l3.match(line)
-                    if mo:
-                        self.l3 = mo.group(1)
+                    self.ts = self.parse_ts(self.timestamp)
+            if lines is None:
+                continue
+            if self.bounds[1] in line:
+                break
+            lines.append(line)
+            pos = line.find(":")
+            if pos < 1:
+                continue
+            tag = line[:pos].lstrip()
+            if len(tag) == pos:
+                continue
+            key = self.tags.get(tag)
+            if key is not None:
+                mo = self.re_value.match(line, pos + 1)
+                if mo:
+                    val = int(mo.group(1))
+                    if key in ("enbid", "trsr") and val == NULL_ENB:
+                        continue
+                    setattr(self, key, val)
+            elif l3 and tag.startswith("L3["):
+                mo = self.re_l3.match(line)
+                if mo:
+                    self.l3 = mo.group(1)
+        if lines is not None:
+            self.text = "".join(lines)
+            self.fp = fingerprint(self.text)
         return self.cardinal_field_val is not None
 
+    @classmethod
+    def prefilter(cls, filters: dict):
+        """Check of a raw body, ``accept(buf, start, end)``, false for bodies
+        ``matches(**filters)`` would reject, before they are parsed.
+
+        Looks up the last line of each filtered key field in the bytes and
+        compares its value; a body where a field is missing or unclear is
+        accepted and left to ``matches()``. None when no key field is
+        filtered.
+        """
+        checks = [
+            (f" {cls.key_fields[key]['tag']}:".encode(), val, key in ("enbid", "trsr"))
+            for key, val in filters.items()
+            if val is not None and key in cls.key_fields
+        ]
+        if not checks:
+            return None
+        re_value = re.compile(cls.re_value.pattern.encode())
+
+        def accept(buf, start: int, end: int) -> bool:
+            for tag, wanted, nullable in checks:
+                pos = buf.rfind(tag, start, end)
+                # the tag must start its line, as from_text() reads it
+                while pos != -1:
+                    line_start = max(buf.rfind(b"\n", start, pos) + 1, start)
+                    if not buf[line_start:pos].strip():
+                        break
+                    pos = buf.rfind(tag, start, pos)
+                if pos == -1:
+                    continue
+                mo = re_value.match(buf, pos + len(tag))
+                if mo is None:
+                    continue
+                val = int(mo.group(1))
+                if nullable and val == NULL_ENB:
+                    continue
+                if val != wanted:
+                    return False
+            return True
+
+        return accept
+
+    def from_span(self, source, start: int, end: int, l3=False):
+        """Parses the body at [start, end) of a MappedFile, keeping only spans
+        of it, for the timestamp and L3 payload too."""
+        result = self.from_text(source.text(start, end).splitlines(True), l3=l3)
+        self.text = None
+        self.source = source
+        self.span = (start, end)
+        buf = source.buffer
+        for attr in ("_timestamp", "_l3"):
+            val = getattr(self, attr)
+            if val is not None:
+                # any occurrence of the text gives it back
+                val = val.encode()
+                setattr(self, attr, (buf.find(val, start, end) - start, len(val)))
+        return result
+
+    def detach(self):
+        """Reads the body out of its MappedFile, e.g. to outlive it."""
+        if self.text is None and self.source is not None:
+            self.text = self.body
+            self._timestamp = self.timestamp
+            self._l3 = self.l3
+            self.source = None
+            self.span = None
+
     def __lt__(self, other):
-        return self.timestamp < other.timestamp
+        return self.ts < other.ts
 
     @property
     def cardinal_field_val(self):
@@ -93,69 +315,80 @@ class Message:
 class Message4G(Message):
     # [650500] INTERNAL_PER_RADIO_UE_MEASUREMENT_TA(3108) @ 06:19:51.247 {
     re_msg_nm = re.compile(r"\[[\d]+\]\W([^\(]+)\([\d]+\)\W@\W([\d:\.]+)\W{")
+    # ENBS1APID: 271461
+    re_value = re.compile(r"\W([\d]+)")
     key_fields = {
-        "gci": {"tag": "GLOBAL_CELL_ID", "regexp": None},
-        "enbid": {"tag": "ENBS1APID", "regexp": None},
-        "trsr": {"tag": "TRACE_RECORDING_SESSION_REFERENCE", "regexp": None},
-        "crnti": {"tag": "CRNTI", "regexp": None},
+        "gci": {"tag": "GLOBAL_CELL_ID"},
+        "enbid": {"tag": "ENBS1APID"},
+        "trsr": {"tag": "TRACE_RECORDING_SESSION_REFERENCE"},
+        "crnti": {"tag": "CRNTI"},
     }
+    __slots__ = tuple(key_fields)
+    key_field = "gci"
+    tags = {field["tag"]: key for key, field in key_fields.items()}
+    time_of_day = True
 
-    def __init__(self):
-        super().__init__()
-        # ENBS1APID: 271461
-        for field in self.key_fields.values():
-            field["regexp"] = re.compile(rf"\W+{field['tag']}:\W([\d]+)")
+    @staticmethod
+    def parse_ts(ts: str) -> int:
+        # 06:19:51.247, ms since midnight
+        return time_of_day_ms(ts)
 
 
 class Message3G(Message):
     # [2610] INTERNAL_SOFT_HANDOVER_EXECUTION(408) @ 2020-09-21T06:37:59.790Z {
     re_msg_nm = re.compile(r"\[[\d]+\]\W([^\(]+)\([\d]+\)\W@\W([\d:\.\-TZ]+)\W{")
+    # UE_CONTEXT_ID: Some(512)
+    # RNC_MODULE_ID: Some(0)
+    # RNC_ID/CELL_ID[1]: (2241, 7079)
+    re_value = re.compile(r"\W[^\(]*\(([\d]+)")
     key_fields = {
-        "rncmodid": {"tag": "RNC_MODULE_ID", "regexp": None},
-        "ueid": {"tag": "UE_CONTEXT_ID", "regexp": None},
-        "rncid": {"tag": r"RNC_ID/CELL_ID\[1\]", "regexp": None},
+        "rncmodid": {"tag": "RNC_MODULE_ID"},
+        "ueid": {"tag": "UE_CONTEXT_ID"},
+        "rncid": {"tag": "RNC_ID/CELL_ID[1]"},
     }
+    __slots__ = tuple(key_fields)
+    key_field = "rncmodid"
+    tags = {field["tag"]: key for key, field in key_fields.items()}
 
-    def __init__(self):
-        super().__init__()
-        # UE_CONTEXT_ID: Some(512)
-        # RNC_MODULE_ID: Some(0)
-        # RNC_ID/CELL_ID[1]: (2241, 7079)
-        for field in self.key_fields.values():
-            field["regexp"] = re.compile(rf"\W+{field['tag']}:\W[^\(]*\(([\d]+)")
+    @staticmethod
+    def parse_ts(ts: str) -> int:
+        # 2020-09-21T06:37:59.790Z, ms since the epoch
+        return epoch_day_ms(ts[0:10]) + time_of_day_ms(ts[11:].rstrip("Z"))
 
 
 class XDR:
+    __slots__ = ("ts_begin", "ts_end", "metas", "messages", "fps", "tmsi", "_descr")
     TS_FORMAT = ("%H:%M:%S.%f", "%H:%M:%S")
     T1 = 60
     I1 = 300
     key_filter = ()
+    # a matching message shares at least one of these with the XDR
+    index_fields = ()
     key_fields = {}
 
     extract_rules = {}
 
     @classmethod
-    def parse_ts(cls, ts: str):
-        if ts in DATE_CACHE:
-            return DATE_CACHE[ts]
-        try:
-            result = datetime.strptime(ts, cls.TS_FORMAT[0])
-        except ValueError:
-            result = datetime.strptime(ts, cls.TS_FORMAT[1])
-        DATE_CACHE[ts] = result
-        return result
+    def format_ts(cls, ts: int) -> str:
+        # time of day only, days added by DayClock are not shown
+        ts = datetime(1900, 1, 1) + timedelta(milliseconds=ts % DAY_MS)
+        return ts.strftime(cls.TS_FORMAT[0])
 
     def __init__(self, msg: Message):
-        self.ts_begin = self.parse_ts(msg.timestamp)
+        self.ts_begin = msg.ts
         self.ts_end = self.ts_begin
         self.metas = []
         self.messages = [msg]
+        # fingerprints of the messages, to skip repeated ones
+        self.fps = {msg.fp}
         self.tmsi = None
+        # get_msg_descr() result, reset when a message is added
+        self._descr = None
         for field in self.key_fields.keys():
             setattr(self, field, getattr(msg, field, None))
 
-    def is_closed(self, last_ts: str):
-        result = (self.parse_ts(last_ts) - self.ts_end).total_seconds() > self.T1
+    def is_closed(self, last_ts: int):
+        result = last_ts - self.ts_end > self.T1 * 1000
         return result
 
     def merge(self, other):
@@ -172,23 +405,17 @@ class XDR:
             key_match &= getattr(self, field, None) == getattr(item, field, None)
 
         if key_match and self.ts_begin is not None and self.ts_end is not None:
-            new_ts = self.parse_ts(item.timestamp)
+            new_ts = item.ts
             if self.ts_begin < new_ts < self.ts_end:
                 return True
-            if (
-                new_ts >= self.ts_end
-                and (new_ts - self.ts_end).total_seconds() < self.I1
-            ):
+            if new_ts >= self.ts_end and new_ts - self.ts_end < self.I1 * 1000:
                 return True
-            if (
-                new_ts <= self.ts_begin
-                and (self.ts_begin - new_ts).total_seconds() < self.I1
-            ):
+            if new_ts <= self.ts_begin and self.ts_begin - new_ts < self.I1 * 1000:
                 return True
         return False
 
     def add_msg(self, msg: Message, meta=None):
-        if msg in self.messages:
+        if msg.fp in self.fps:
             # print("same message", file=sys.stderr)
             return
         for field, attr in self.key_fields.items():
@@ -198,37 +425,51 @@ class XDR:
                 if s_v is not None and attr["strict"]:
                     assert s_v == o_v
                 setattr(self, field, o_v)
-        self.ts_end = max(self.ts_end, self.parse_ts(msg.timestamp))
+        self.ts_end = max(self.ts_end, msg.ts)
         self.messages.append(msg)
+        self.fps.add(msg.fp)
+        self._descr = None
+
+        if meta:
+            self.extract_meta(msg.name, meta)
 
-        if not meta:
+    def extract_meta(self, name: str, meta: str):
+        """Sets the ``extract_rules`` fields still unset from the decoded L3
+        of a message called ``name``, first value of each field."""
+        matcher = meta_matcher(type(self), name)
+        if matcher is None:
             return
-        for meta_id in self.extract_rules:
-            # meta_id=='imsi'
-            if msg.name in self.extract_rules[meta_id]:
-                ws_filters = self.extract_rules[meta_id][msg.name]
-                value = None
-                for line, ws_filter in itertools.product(meta.split("\n"), ws_filters):
-                    if ws_filter in line:
-                        mo = re_l3_value.search(line)
-                        if mo:
-                            value = mo.group(1)
-                if value:
-                    try:
-                        value = int("0x" + value, 16)
-                    except ValueError:
-                        value = int(value)
-                    self_val = getattr(self, meta_id)
-                    if self_val is not None:
-                        if self_val != value:
-                            print(
-                                f"replacing {meta_id}. old: {self_val},"
-                                f"new: {value}",
-                                file=sys.stderr,
-                            )
-                        # assert self_val == value
-                    else:
-                        setattr(self, meta_id, value)
+        meta_ids = [key for key in matcher.groupindex if key != "value"]
+        found = set()
+        for mo in matcher.finditer(meta):
+            meta_id = next(key for key in meta_ids if mo.group(key))
+            if meta_id in found:
+                continue
+            found.add(meta_id)
+            value = mo.group("value")
+            try:
+                value = int("0x" + value, 16)
+            except ValueError:
+                value = int(value)
+            self_val = getattr(self, meta_id)
+            if self_val is not None:
+                if self_val != value:
+                    print(
+                        f"replacing {meta_id}. old: {self_val},new: {value}",
+                        file=sys.stderr,
+                    )
+                # assert self_val == value
+            else:
+                setattr(self, meta_id, value)
+            if len(found) == len(meta_ids):
+                break
+
+    @classmethod
+    def meta_names(cls) -> frozenset:
+        """Names of the messages ``extract_rules`` read fields from."""
+        return frozenset(
+            name for rules in cls.extract_rules.values() for name in rules
+        )
 
     def add_meta(self, metas: str):
         if metas not in self.metas:
@@ -242,23 +483,20 @@ class XDR:
         return result
 
     def __repr__(self):
-        ts_begin = self.ts_begin.strftime(self.TS_FORMAT[0])
-        ts_end = self.ts_end.strftime(self.TS_FORMAT[0])
+        ts_begin = self.format_ts(self.ts_begin)
+        ts_end = self.format_ts(self.ts_end)
         result = f"{ts_begin} -- {ts_end}({len(self.messages)}): {self.tmsi}\t\t"
         for key in self.key_fields.keys():
             result += f"{key}:{getattr(self,key,None)}\t"
         return result + "\n"
 
-    def get_msg_descr(self):
-        return set(
-            sorted(
-                [
-                    msg.name
-                    for msg in self.messages
-                    if not msg.name.startswith("INTERNAL")
-                ]
+    def get_msg_descr(self) -> frozenset:
+        """Names of the messages, INTERNAL ones left out, see ``XDR_scenario``."""
+        if self._descr is None:
+            self._descr = frozenset(
+                msg.name for msg in self.messages if not msg.name.startswith("INTERNAL")
             )
-        )
+        return self._descr
 
 
 class XDR3G(XDR):
@@ -270,11 +508,17 @@ class XDR3G(XDR):
         "rncmodid": {"strict": True},
         "ueid": {"strict": True},
     }
+    __slots__ = tuple(key_fields)
 
     def __init__(self, msg: Message3G):
         assert isinstance(msg, Message3G)
         super().__init__(msg)
 
+    @classmethod
+    def format_ts(cls, ts: int) -> str:
+        ts = datetime(1970, 1, 1) + timedelta(milliseconds=ts)
+        return ts.strftime(cls.TS_FORMAT[0])
+
     def matches(self, item: Message3G):
         assert isinstance(item, Message3G)
         key_match: bool = True
@@ -285,12 +529,14 @@ class XDR3G(XDR):
 class XDR4G(XDR):
     x2_hnd_req = "X2_HANDOVER_REQUEST"
     key_filter = ("gci",)
+    index_fields = ("enbid", "crnti")
     key_fields = {
         "gci": {"strict": True},
         "enbid": {"strict": True},
         "crnti": {"strict": False},
         "trsr": {"strict": True},
     }
+    __slots__ = tuple(key_fields)
     extract_rules = {
         "tmsi": {
             "RRC_RRC_CONNECTION_SETUP_COMPLETE": ("gsm_a.tmsi", "nas_eps.emm.m_tmsi"),
@@ -328,37 +574,90 @@ class XDR4G(XDR):
 
 
 class XDR_scenario:
+    """Numbers of the scenarios, the sets of message names XDRs are made of.
+
+    The ``scenarios`` CSV is append-only: it is read on first use, and a
+    scenario seen for the first time is written right away, under an
+    exclusive lock, after reading the rows other runs appended meanwhile.
+    Numbers are row positions, runs sharing the file agree on them.
+    """
+
     persistent_name = "scenarios"
     key_nb = "number"
     key_msgs = "msgs"
     delim = ";"
 
     def __init__(self, file_name=None):
-        self._xdr_scenarios = []
+        # scenario number -> message names
+        self._xdr_scenarios: List[frozenset] = []
+        # message names -> scenario number
+        self._numbers: Dict[frozenset, int] = {}
         self._file_name = file_name if file_name else self.persistent_name
+        # bytes of the file already read, None until loaded
+        self._offset = None
+
+    def _register(self, scenario: frozenset):
+        # a scenario listed twice keeps its first number
+        self._numbers.setdefault(scenario, len(self._xdr_scenarios))
+        self._xdr_scenarios.append(scenario)
+
+    def _read_new_rows(self, file_hnd):
+        file_hnd.seek(self._offset)
+        data = file_hnd.read()
+        rows = csv.reader(io.StringIO(data.decode()))
+        if self._offset == 0:
+            next(rows, None)
+        for row in rows:
+            msgs = row[1] if len(row) > 1 else ""
+            # an XDR of INTERNAL messages only is saved as an empty field
+            self._register(frozenset(msgs.split(self.delim) if msgs else ()))
+        self._offset += len(data)
 
     def load_persistent(self):
+        """Reads the rows appended to the file since the last call."""
+        if self._offset is None:
+            self._offset = 0
         path = pathlib.Path(self._file_name)
         if not path.exists():
             return
-        with open(path, "r") as file_hnd:
-            dict_reader = csv.DictReader(file_hnd)
-            for line in dict_reader:
-                self._xdr_scenarios.append(set(line[self.key_msgs].split(self.delim)))
-
-    def save_persistent(self):
-        with open(self._file_name, "w") as file_hnd:
-            dict_writer = csv.DictWriter(
-                file_hnd, fieldnames=[self.key_nb, self.key_msgs]
-            )
-            dict_writer.writeheader()
-            for nb, scenario in enumerate(self._xdr_scenarios):
-                dict_writer.writerow(
-                    {self.key_nb: nb, self.key_msgs: self.delim.join(scenario)}
-                )
-
-    def scenario_nb(self, scenario: str) -> int:
-        if scenario not in self._xdr_scenarios:
-            self._xdr_scenarios.append(scenario)
-        result = self._xdr_scenarios.index(scenario)
+        with open(path, "rb") as file_hnd:
+            _lock(file_hnd, shared=True)
+            self._read_new_rows(file_hnd)
+
+    def _append(self, scenario: frozenset) -> int:
+        with open(self._file_name, "a+b") as file_hnd:
+            _lock(file_hnd)
+            self._read_new_rows(file_hnd)
+            result = self._numbers.get(scenario)
+            if result is not None:
+                # found by another run meanwhile
+                return result
+            result = len(self._xdr_scenarios)
+            text = io.StringIO()
+            writer = csv.writer(text)
+            if self._offset == 0:
+                writer.writerow([self.key_nb, self.key_msgs])
+            writer.writerow([result, self.delim.join(sorted(scenario))])
+            data = text.getvalue().encode()
+            file_hnd.write(data)
+            file_hnd.flush()
+            self._offset += len(data)
+            self._register(scenario)
+            return result
+
+    def scenario_nb(self, scenario) -> int:
+        """Number of the set of message names ``scenario``, a new one is
+        numbered after the known ones."""
+        if self._offset is None:
+            self.load_persistent()
+        scenario = frozenset(scenario)
+        result = self._numbers.get(scenario)
+        if result is None:
+            result = self._append(scenario)
         return result
+
+
+def _lock(file_hnd, shared: bool = False):
+    # released when the file is closed
+    if fcntl is not None:
+        fcntl.flock(file_hnd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
@@ -0,0 +1,132 @@
+import array
+import operator
+from typing import List
+
+from .classes import FP_SIZE, XDR, Message
+
+__all__ = ["MessageColumns", "build_xdr"]
+
+# stands for None in the integer columns
+NONE = -(2 ** 63)
+
+
+class MessageColumns:
+    """The fields correlation reads from a list of messages, one array each.
+
+    Sent to correlation workers instead of the messages themselves: no body
+    text nor L3 payload, only the name, the timestamp, the key fields and
+    a fingerprint of the body standing in for it in comparisons. Workers
+    rebuild bare messages with ``messages()`` and return XDRs as lists of
+    row numbers, the parent rebuilds them over its own messages with
+    ``build_xdr()``.
+    """
+
+    def __init__(self, message_class, msgs=()):
+        self.message_class = message_class
+        self.names: List[str] = []
+        self.name_ids = array.array("H")
+        self.ts = array.array("q")
+        self.fields = {key: array.array("q") for key in message_class.key_fields}
+        self.fps = bytearray()
+        self._name_ids = {}
+        for msg in msgs:
+            self.append(msg)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_name_ids"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._name_ids = {name: nb for nb, name in enumerate(self.names)}
+
+    def append(self, msg: Message):
+        name_id = self._name_ids.get(msg.name)
+        if name_id is None:
+            name_id = self._name_ids[msg.name] = len(self.names)
+            self.names.append(msg.name)
+        self.name_ids.append(name_id)
+        self.ts.append(msg.ts)
+        for key, column in self.fields.items():
+            val = getattr(msg, key)
+            column.append(NONE if val is None else val)
+        self.fps += msg.fp
+
+    def extend(self, other: "MessageColumns"):
+        names = self._name_ids
+        for name in other.names:
+            if name not in names:
+                names[name] = len(self.names)
+                self.names.append(name)
+        ids = [names[name] for name in other.names]
+        self.name_ids.extend(ids[name_id] for name_id in other.name_ids)
+        self.ts.extend(other.ts)
+        for key, column in self.fields.items():
+            column.extend(other.fields[key])
+        self.fps += other.fps
+
+    def take(self, rows: List[int]) -> "MessageColumns":
+        """The columns of ``rows`` only, in that order, as arrays of their own
+        even when these columns map a file."""
+        result = MessageColumns(self.message_class)
+        result.names = list(self.names)
+        result._name_ids = dict(self._name_ids)
+        fps = memoryview(self.fps)
+        if rows == range(len(self)):
+            result.fps = bytearray(fps)
+            columns = [self.name_ids, self.ts] + list(self.fields.values())
+        elif len(rows):
+            result.fps = bytearray().join(
+                fps[row * FP_SIZE : (row + 1) * FP_SIZE] for row in rows
+            )
+            pick = operator.itemgetter(*rows)
+            columns = [self.name_ids, self.ts] + list(self.fields.values())
+            columns = [pick(column) for column in columns]
+            if len(rows) == 1:
+                columns = [(val,) for val in columns]
+        else:
+            return result
+        targets = [result.name_ids, result.ts] + list(result.fields.values())
+        for target, column in zip(targets, columns):
+            target.extend(column)
+        return result
+
+    def messages(self, rows: List[int] = None) -> List[Message]:
+        """Bare messages, one per row or per given row, enough for
+        ``Correlator``."""
+        result = []
+        fields = list(self.fields.items())
+        message_class, names, name_ids, ts = (
+            self.message_class,
+            self.names,
+            self.name_ids,
+            self.ts,
+        )
+        fps = memoryview(self.fps)
+        for row in range(len(self)) if rows is None else rows:
+            msg = message_class()
+            msg.name = names[name_ids[row]]
+            msg.ts = ts[row]
+            for key, column in fields:
+                val = column[row]
+                if val != NONE:
+                    setattr(msg, key, val)
+            msg.fp = bytes(fps[row * FP_SIZE : (row + 1) * FP_SIZE])
+            result.append(msg)
+        return result
+
+
+def build_xdr(xdr_class, msgs: List[Message], rows: List[int]) -> XDR:
+    """The XDR holding ``msgs`` at ``rows``, in that order.
+
+    Adding the messages one by one in the order the XDR holds them gives
+    back the same times and key fields, merges included.
+    """
+    xdr = xdr_class(msgs[rows[0]])
+    for row in rows[1:]:
+        xdr.add_msg(msgs[row])
+    return xdr
@@ -0,0 +1,353 @@
+import heapq
+import operator
+import os
+import pathlib
+import pickle
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from .classes import XDR, Message
+from .columns import NONE, MessageColumns
+
+__all__ = ["Checkpoint", "Correlator", "Sharder", "connected"]
+
+
+def connected(labels: List[list]) -> List[int]:
+    """Component number of each item, given the labels it carries: items
+    sharing a label, directly or through other items, share a component.
+    Items without labels stay alone."""
+    parent = {}
+
+    def find(label):
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    roots = []
+    for item_labels in labels:
+        if not item_labels:
+            roots.append(None)
+            continue
+        for label in item_labels:
+            parent.setdefault(label, label)
+        root = find(item_labels[0])
+        for label in item_labels[1:]:
+            other = find(label)
+            if other != root:
+                parent[other] = root
+        roots.append(item_labels[0])
+    numbers = {}
+    return [
+        numbers.setdefault(object() if label is None else find(label), len(numbers))
+        for label in roots
+    ]
+
+
+class Correlator:
+    """Groups messages of one shard into XDRs.
+
+    Open XDRs are filed in an index keyed on ``key_filter`` values and, when
+    the XDR class declares ``index_fields``, on each of those fields too. A
+    message is only checked against the XDRs sharing one of its index keys,
+    which is a superset of the XDRs ``XDR.matches`` could accept.
+
+    Open XDRs also sit in a heap ordered by ``ts_end``. With a
+    ``reorder_window``, as when streaming, an XDR is moved to the finished
+    list (see ``drain()``) once the stream time, the latest timestamp seen,
+    is more than ``T1`` plus ``reorder_window`` seconds past its end. A
+    message arriving later than that behind the stream time starts an XDR
+    of its own instead of extending it as ``XDR.matches`` would. Without
+    one, XDRs stay open until ``expire()`` or ``flush()``, and the result is
+    the one of a scan of every XDR.
+    """
+
+    def __init__(self, xdr_class, reorder_window: float = None):
+        self.xdr_class = xdr_class
+        self.reorder_window = reorder_window
+        self.watermark = None
+        self._serial = 0
+        # serial -> XDR, kept in creation order
+        self._xdrs: Dict[int, XDR] = {}
+        # index key -> {serial: XDR}
+        self._index = defaultdict(dict)
+        # serial -> index keys the XDR is filed under
+        self._keys: Dict[int, list] = {}
+        # (ts_end, serial), at most one entry per open XDR, may be stale
+        self._heap = []
+        # (serial, XDR) closed but not drained yet
+        self._finished = []
+
+    def __len__(self):
+        return len(self._xdrs)
+
+    def index_keys(self, item) -> list:
+        primary = tuple(
+            getattr(item, field, None) for field in self.xdr_class.key_filter
+        )
+        if not self.xdr_class.index_fields:
+            return [primary]
+        result = []
+        for field in self.xdr_class.index_fields:
+            val = getattr(item, field, None)
+            if val is not None:
+                result.append((primary, field, val))
+        return result
+
+    def _file(self, serial: int):
+        xdr = self._xdrs[serial]
+        keys = self.index_keys(xdr)
+        if keys == self._keys.get(serial):
+            return
+        self._unfile(serial)
+        for key in keys:
+            self._index[key][serial] = xdr
+        self._keys[serial] = keys
+
+    def _unfile(self, serial: int):
+        for key in self._keys.pop(serial, ()):
+            bucket = self._index[key]
+            del bucket[serial]
+            if not bucket:
+                del self._index[key]
+
+    def _close(self, serial: int):
+        self._unfile(serial)
+        self._finished.append((serial, self._xdrs.pop(serial)))
+
+    def _expire(self, reorder_window: float):
+        limit = self.watermark - (self.xdr_class.T1 + reorder_window) * 1000
+        while self._heap and self._heap[0][0] < limit:
+            ts_end, serial = heapq.heappop(self._heap)
+            xdr = self._xdrs.get(serial)
+            if xdr is None:
+                # merged into another XDR
+                continue
+            if xdr.ts_end > ts_end:
+                heapq.heappush(self._heap, (xdr.ts_end, serial))
+                continue
+            self._close(serial)
+
+    def candidates(self, msg: Message) -> List[int]:
+        result = set()
+        for key in self.index_keys(msg):
+            bucket = self._index.get(key)
+            if bucket:
+                result.update(bucket)
+        return sorted(result)
+
+    def advance(self, ts: int):
+        """Moves the stream time forward, closing the XDRs left behind."""
+        if self.watermark is None or ts > self.watermark:
+            self.watermark = ts
+            if self.reorder_window is not None:
+                self._expire(self.reorder_window)
+
+    def expire(self, ts: int, reorder_window: float):
+        """Moves the stream time to ``ts`` and closes the XDRs ending more
+        than ``T1`` plus ``reorder_window`` seconds before it, e.g. those a
+        batch run does not keep in its checkpoint."""
+        self.advance(ts)
+        self._expire(reorder_window)
+
+    def resume(self, xdrs: List[XDR], watermark: int = None):
+        """Takes back XDRs left open by a previous run, see ``Checkpoint``."""
+        for xdr in xdrs:
+            self._xdrs[self._serial] = xdr
+            self._file(self._serial)
+            heapq.heappush(self._heap, (xdr.ts_end, self._serial))
+            self._serial += 1
+        if watermark is not None:
+            self.advance(watermark)
+
+    def add(self, msg: Message):
+        self.advance(msg.ts)
+        matches = [
+            serial
+            for serial in self.candidates(msg)
+            if not self._xdrs[serial].is_closed(msg.ts)
+            and self._xdrs[serial].matches(msg)
+        ]
+        if matches:
+            target = self._xdrs[matches[0]]
+            for serial in matches[1:]:
+                target.merge(self._xdrs[serial])
+            for serial in matches[1:]:
+                self._unfile(serial)
+                del self._xdrs[serial]
+            target.add_msg(msg)
+            self._file(matches[0])
+        else:
+            xdr = self.xdr_class(msg)
+            self._xdrs[self._serial] = xdr
+            self._file(self._serial)
+            heapq.heappush(self._heap, (xdr.ts_end, self._serial))
+            self._serial += 1
+
+    def drain(self) -> List[XDR]:
+        """Finished XDRs closed since the last call, in closing order."""
+        result = [xdr for _, xdr in self._finished]
+        del self._finished[:]
+        return result
+
+    def flush(self) -> List[XDR]:
+        """Closes every open XDR, e.g. at the end of the stream."""
+        for serial in list(self._xdrs):
+            self._close(serial)
+        self._heap = []
+        return self.drain()
+
+    def open_xdrs(self) -> List[XDR]:
+        """XDRs a later message may still extend, in creation order."""
+        return list(self._xdrs.values())
+
+    @property
+    def xdrs(self) -> List[XDR]:
+        """XDRs not drained yet, finished or open, in creation order."""
+        result = self._finished + list(self._xdrs.items())
+        return [xdr for _, xdr in sorted(result, key=lambda item: item[0])]
+
+
+class Sharder:
+    """Routes messages and XDRs to one of ``shards`` correlation workers.
+
+    Everything one XDR may hold shares its ``key_filter`` values, so when
+    messages are routed as they come each distinct key is bound to a single
+    shard, the first time it is seen, to the shard with the fewest messages
+    so far. When all messages are known up front, ``split()`` routes the
+    groups of messages one XDR may link instead, so that a busy key is
+    spread over several shards.
+    """
+
+    def __init__(self, xdr_class, shards: int):
+        self.xdr_class = xdr_class
+        self.key = operator.attrgetter(*xdr_class.key_filter)
+        self._shards = {}
+        # messages routed to each shard
+        self.loads = [0] * shards
+
+    def split(
+        self, groups: List[List[Message]], columns: MessageColumns = None
+    ) -> List[int]:
+        """Shards of ``groups`` of messages, e.g. single messages and the
+        messages of XDRs resumed from a checkpoint, then of each row of
+        ``columns`` when given.
+
+        Groups linked by their ``key_filter`` values and an index field, see
+        ``connected()``, go to the same shard: the linked groups are bound
+        largest first to the least loaded shard (longest processing time
+        first)."""
+        fields = self.xdr_class.key_filter + self.xdr_class.index_fields
+        key_nb = len(self.xdr_class.key_filter)
+        get = operator.attrgetter(*fields)
+        # distinct field values, NONE for None as in columns, then the ones
+        # of each group
+        values = {}
+        group_values = [
+            [
+                values.setdefault(
+                    tuple(NONE if val is None else val for val in get(msg)),
+                    len(values),
+                )
+                for msg in group
+            ]
+            for group in groups
+        ]
+        if columns is not None:
+            column_values = zip(*(columns.fields[field] for field in fields))
+            group_values.extend(
+                [values.setdefault(item, len(values))] for item in column_values
+            )
+        labels = []
+        for nb, item in enumerate(values):
+            key = item[:key_nb]
+            if self.xdr_class.index_fields:
+                labels.append(
+                    [
+                        (key, field, val)
+                        for field, val in enumerate(item[key_nb:])
+                        if val != NONE
+                    ]
+                    or [nb]
+                )
+            else:
+                labels.append([key])
+        # an XDR links the values of its messages
+        for rows in group_values:
+            if len(rows) > 1:
+                labels.append([label for row in rows for label in labels[row]])
+        component = connected(labels)
+        weights = Counter()
+        for rows in group_values:
+            weights[component[rows[0]]] += len(rows)
+        loads = [(load, shard) for shard, load in enumerate(self.loads)]
+        heapq.heapify(loads)
+        shards = {}
+        for number, weight in weights.most_common():
+            load, shard = heapq.heappop(loads)
+            shards[number] = shard
+            self.loads[shard] += weight
+            heapq.heappush(loads, (load + weight, shard))
+        return [shards[component[rows[0]]] for rows in group_values]
+
+    def __call__(self, item, weight: int = 1) -> int:
+        key = self.key(item)
+        shard = self._shards.get(key)
+        if shard is None:
+            shard = self._shards[key] = self.loads.index(min(self.loads))
+        self.loads[shard] += weight
+        return shard
+
+
+class Checkpoint:
+    """Sessions still open at the end of a run, for the run over the next files.
+
+    Keeps the open XDRs, the stream time, the ``DayClock`` of time-of-day
+    traces and the input files already processed. Message bodies are stored
+    as text, the old files are not needed to resume.
+    """
+
+    VERSION = 4
+
+    def __init__(self, xdr_class, xdrs=(), watermark=None, clock=None, files=()):
+        self.xdr_class = xdr_class
+        self.xdrs = list(xdrs)
+        self.watermark = watermark
+        self.clock = clock
+        self.files = list(files)
+
+    def save(self, path):
+        for xdr in self.xdrs:
+            for msg in xdr.messages:
+                msg.detach()
+        state = {
+            "version": self.VERSION,
+            "xdr_class": self.xdr_class.__name__,
+            "xdrs": self.xdrs,
+            "watermark": self.watermark,
+            "clock": self.clock,
+            "files": self.files,
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file_hnd:
+            pickle.dump(state, file_hnd, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, xdr_class):
+        """The checkpoint at ``path``, an empty one when there is none yet."""
+        if not pathlib.Path(path).exists():
+            return cls(xdr_class)
+        with open(path, "rb") as file_hnd:
+            state = pickle.load(file_hnd)
+        if state.get("version") != cls.VERSION:
+            raise ValueError(f"{path}: unsupported checkpoint version")
+        if state["xdr_class"] != xdr_class.__name__:
+            raise ValueError(f"{path}: checkpoint of {state['xdr_class']}")
+        return cls(
+            xdr_class,
+            state["xdrs"],
+            state["watermark"],
+            state["clock"],
+            state["files"],
+        )
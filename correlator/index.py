@@ -0,0 +1,331 @@
+import array
+import bisect
+import concurrent.futures
+import hashlib
+import mmap
+import os
+import pathlib
+import pickle
+import sys
+from typing import Dict, List
+
+from .classes import FP_SIZE, Message
+from .columns import NONE, MessageColumns
+from .source import MappedFile
+
+__all__ = ["MessageIndex", "MessageRows", "index_chunk"]
+
+MAGIC = b"CORRIDX\n"
+# header length field, then the pickled header, arrays follow 8-byte aligned
+HEADER_LEN = 8
+
+
+def parser_version(Message_) -> str:
+    """Changes whenever what ``Message_`` reads out of a body may change."""
+    text = repr(
+        (
+            MessageIndex.VERSION,
+            Message_.__name__,
+            Message_.re_msg_nm.pattern,
+            Message_.re_value.pattern,
+            Message_.re_l3.pattern,
+            sorted(Message_.tags.items()),
+        )
+    )
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def index_chunk(
+    source: MappedFile, Message_, start: int, end: int, l3=True, filters=None
+):
+    """Index of the messages of one byte range, run in a parsing worker.
+    With ``filters``, only of the messages ``Message.matches()`` accepts."""
+    index = MessageIndex(Message_)
+    prefilter = Message_.prefilter(filters) if filters else None
+    for msg in source.messages(
+        Message_, l3=l3, start=start, end=end, prefilter=prefilter
+    ):
+        if not filters or msg.matches(**filters):
+            index.append(msg)
+    return index
+
+
+class MessageIndex:
+    """What parsing a trace file yields, without the parsing.
+
+    The ``MessageColumns`` of every message of a file plus the byte spans of
+    its body, timestamp and L3 payload. Saved next to the file, or in a
+    cache directory, as a sidecar of raw arrays which later runs map and
+    turn back into messages backed by a ``MappedFile``, as with ``--mmap``,
+    or correlate as they are, see ``MessageRows``.
+    A sidecar is used only while the size and modification time of its
+    file and the parser are unchanged.
+    """
+
+    VERSION = 1
+
+    def __init__(self, message_class):
+        self.message_class = message_class
+        self.columns = MessageColumns(message_class)
+        # body start and end, per message
+        self.spans = array.array("q")
+        # timestamp offset in the body and length
+        self.ts_at = array.array("H")
+        self.ts_len = array.array("B")
+        # L3 payload start in the file, -1 without one, and length
+        self.l3_at = array.array("q")
+        self.l3_len = array.array("I")
+        self._map = None
+
+    def __len__(self):
+        return len(self.columns)
+
+    def append(self, msg):
+        """Adds a message read with ``Message.from_span()``, with the spans of
+        its timestamp and L3 payload."""
+        self.columns.append(msg)
+        self.spans.extend(msg.span)
+        ts_at, ts_len = msg._timestamp
+        self.ts_at.append(ts_at)
+        self.ts_len.append(ts_len)
+        if msg._l3 is None:
+            self.l3_at.append(-1)
+            self.l3_len.append(0)
+        else:
+            l3_at, l3_len = msg._l3
+            self.l3_at.append(msg.span[0] + l3_at)
+            self.l3_len.append(l3_len)
+
+    def extend(self, other: "MessageIndex"):
+        self.columns.extend(other.columns)
+        for attr in ("spans", "ts_at", "ts_len", "l3_at", "l3_len"):
+            getattr(self, attr).extend(getattr(other, attr))
+
+    def _arrays(self) -> Dict[str, object]:
+        result = {
+            "name_ids": self.columns.name_ids,
+            "ts": self.columns.ts,
+            "fps": self.columns.fps,
+            "spans": self.spans,
+            "ts_at": self.ts_at,
+            "ts_len": self.ts_len,
+            "l3_at": self.l3_at,
+            "l3_len": self.l3_len,
+        }
+        for key, column in self.columns.fields.items():
+            result[f"field.{key}"] = column
+        return result
+
+    @staticmethod
+    def sidecar(path: pathlib.Path, cache_dir: str = None) -> pathlib.Path:
+        """Where the index of ``path`` is kept, next to it by default."""
+        if not cache_dir:
+            return path.with_name(path.name + ".idx")
+        digest = hashlib.blake2b(
+            str(path.resolve()).encode(), digest_size=6
+        ).hexdigest()
+        return pathlib.Path(cache_dir) / f"{path.name}.{digest}.idx"
+
+    @staticmethod
+    def _stamp(path: pathlib.Path, Message_) -> dict:
+        stat = path.stat()
+        return {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "parser": parser_version(Message_),
+        }
+
+    def save(self, path: pathlib.Path, source_path: pathlib.Path):
+        arrays = self._arrays()
+        layout = []
+        offset = 0
+        for key, values in arrays.items():
+            nbytes = len(memoryview(values).cast("B"))
+            typecode = "B" if isinstance(values, bytearray) else values.typecode
+            layout.append((key, typecode, offset, nbytes))
+            offset += -(-nbytes // 8) * 8
+        header = pickle.dumps(
+            {
+                "source": self._stamp(source_path, self.message_class),
+                "names": self.columns.names,
+                "arrays": layout,
+            },
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+        header += b"\0" * (-len(header) % 8)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file_hnd:
+            file_hnd.write(MAGIC)
+            file_hnd.write(len(header).to_bytes(HEADER_LEN, "little"))
+            file_hnd.write(header)
+            for (_, _, _, nbytes), values in zip(layout, arrays.values()):
+                file_hnd.write(memoryview(values).cast("B"))
+                file_hnd.write(b"\0" * (-nbytes % 8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path, source_path: pathlib.Path, Message_):
+        """The index saved at ``path``, None when missing or out of date."""
+        try:
+            file_hnd = open(path, "rb")
+        except OSError:
+            return None
+        with file_hnd:
+            if file_hnd.read(len(MAGIC)) != MAGIC:
+                return None
+            header_len = int.from_bytes(file_hnd.read(HEADER_LEN), "little")
+            try:
+                header = pickle.loads(file_hnd.read(header_len))
+                stamp, layout = header["source"], header["arrays"]
+            except Exception:
+                # truncated or corrupt, rebuilt as when out of date
+                return None
+            if stamp != cls._stamp(source_path, Message_):
+                return None
+            data_start = len(MAGIC) + HEADER_LEN + header_len
+            data_end = data_start + max(
+                (offset + nbytes for _, _, offset, nbytes in layout), default=0
+            )
+            if os.fstat(file_hnd.fileno()).st_size < data_end:
+                return None
+            buf = mmap.mmap(file_hnd.fileno(), 0, access=mmap.ACCESS_READ)
+        index = cls(Message_)
+        index._map = buf
+        view = memoryview(buf)[data_start:]
+        arrays = {
+            key: view[offset : offset + nbytes].cast(typecode)
+            for key, typecode, offset, nbytes in layout
+        }
+        columns = index.columns
+        columns.names = [sys.intern(name) for name in header["names"]]
+        columns._name_ids = {name: nb for nb, name in enumerate(columns.names)}
+        columns.name_ids = arrays["name_ids"]
+        columns.ts = arrays["ts"]
+        columns.fps = arrays["fps"]
+        for key in columns.fields:
+            columns.fields[key] = arrays[f"field.{key}"]
+        for attr in ("spans", "ts_at", "ts_len", "l3_at", "l3_len"):
+            setattr(index, attr, arrays[attr])
+        return index
+
+    @classmethod
+    def build(cls, source: MappedFile, Message_, jobs: int = 1, chunk_size=None):
+        """Parses the whole file, by chunks in ``jobs`` processes."""
+        if jobs <= 1 or chunk_size is None:
+            return index_chunk(source, Message_, 0, len(source))
+        index = cls(Message_)
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = [
+                executor.submit(index_chunk, source, Message_, start, end)
+                for start, end in source.chunks(Message_.re_msg_nm, chunk_size)
+            ]
+            for future in futures:
+                index.extend(future.result())
+        return index
+
+    @classmethod
+    def open(
+        cls, path, Message_, cache_dir: str = None, jobs: int = 1, chunk_size=None
+    ):
+        """The index of the file at ``path``, from its sidecar when up to
+        date, else parsed and saved. The file is only mapped, or a ``.gz``
+        one decompressed, to be parsed."""
+        path = pathlib.Path(path)
+        sidecar = cls.sidecar(path, cache_dir)
+        index = cls.load(sidecar, path, Message_)
+        if index is None:
+            index = cls.build(MappedFile.open(path), Message_, jobs, chunk_size)
+            try:
+                index.save(sidecar, path)
+            except OSError as exc:
+                print(f"{path}: parse cache not saved, {exc}", file=sys.stderr)
+        return index
+
+    def rows(self, filters=None) -> List[int]:
+        """Rows of the messages ``Message.matches(**filters)`` accepts."""
+        checks = [
+            (self.columns.fields[key], val)
+            for key, val in (filters or {}).items()
+            if val is not None and key in self.columns.fields
+        ]
+        if not checks:
+            return range(len(self))
+        columns = [column for column, _ in checks]
+        wanted = [(NONE, val) for _, val in checks]
+        return [
+            row
+            for row, vals in enumerate(zip(*columns))
+            if all(val in accepted for val, accepted in zip(vals, wanted))
+        ]
+
+    def message(self, row: int, source: MappedFile, l3: bool = False):
+        """The message at ``row``, its body read from ``source``."""
+        columns = self.columns
+        msg = self.message_class()
+        msg.name = columns.names[columns.name_ids[row]]
+        msg.ts = columns.ts[row]
+        for key, column in columns.fields.items():
+            val = column[row]
+            if val != NONE:
+                setattr(msg, key, val)
+        msg.fp = bytes(columns.fps[row * FP_SIZE : (row + 1) * FP_SIZE])
+        msg.source = source
+        start = self.spans[2 * row]
+        msg.span = (start, self.spans[2 * row + 1])
+        # read from the mapping when asked for, see Message.from_span()
+        msg._timestamp = (self.ts_at[row], self.ts_len[row])
+        l3_at = self.l3_at[row]
+        if l3 and l3_at >= 0:
+            msg._l3 = (l3_at - start, self.l3_len[row])
+        return msg
+
+    def messages(self, source: MappedFile, l3: bool = False, filters=None):
+        """Messages ``Message.matches(**filters)`` accepts, bodies read from
+        ``source``."""
+        for row in self.rows(filters):
+            yield self.message(row, source, l3)
+
+
+class MessageRows:
+    """The messages of several files, e.g. of one run, as one
+    ``MessageColumns`` taken from their ``MessageIndex``.
+
+    Messages, and the mapping of their file, are only made for the rows
+    asked for, once these columns have been correlated.
+    """
+
+    def __init__(self, message_class):
+        self.columns = MessageColumns(message_class)
+        # first row of each file, then its path, index and index rows
+        self._starts = []
+        self._files = []
+
+    def __len__(self):
+        return len(self.columns)
+
+    def add(self, path, index: MessageIndex, filters=None, clock=None):
+        """Adds the rows of ``index`` ``Message.matches(**filters)`` accepts,
+        with their timestamps turned by ``clock`` when given."""
+        rows = index.rows(filters)
+        columns = index.columns.take(rows)
+        if clock is not None:
+            columns.ts = array.array("q", map(clock, columns.ts))
+        self._starts.append(len(self))
+        self._files.append((path, index, rows))
+        self.columns.extend(columns)
+
+    def messages(self, rows: List[int], l3: bool = False) -> List[Message]:
+        """The messages at ``rows``, as ``MessageIndex.messages()`` makes them."""
+        result = []
+        sources = {}
+        ts = self.columns.ts
+        for row in rows:
+            nb = bisect.bisect_right(self._starts, row) - 1
+            path, index, index_rows = self._files[nb]
+            source = sources.get(nb)
+            if source is None:
+                source = sources[nb] = MappedFile.open(path)
+            msg = index.message(index_rows[row - self._starts[nb]], source, l3)
+            msg.ts = ts[row]
+            result.append(msg)
+        return result
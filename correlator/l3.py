@@ -0,0 +1,284 @@
+import os
+import queue
+import re
+import sqlite3
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .classes import Message
+
+__all__ = ["L3Cache", "L3Decoder", "L3_LOOK_FOR"]
+
+L3_LOOK_FOR = ("tmsi", "imsi", "imei", "teid")
+# all payloads are written as DLT_USER0, tshark maps it to the dissector
+USER_DLT = 147
+TSHARK_CMD = (
+    "tshark",
+    "-n",
+    "-l",
+    "-o",
+    'uat:user_dlts:"User 0 (DLT=147)","{dlt}","0","","0",""',
+    "-V",
+    "-T",
+    "pdml",
+    "-r",
+    "-",
+)
+PCAP_HEADER = struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, USER_DLT)
+
+
+def l3_bytes(l3: str) -> bytes:
+    # like xxd -r -p, a dangling nibble is dropped
+    return bytes.fromhex(l3[: len(l3) // 2 * 2])
+
+
+def pcap_record(payload: bytes) -> bytes:
+    return struct.pack("<IIII", 0, 0, len(payload), len(payload)) + payload
+
+
+class DecoderProcess:
+    """One long-lived tshark reading a pcap stream on stdin.
+
+    A reader thread splits the PDML output into ``<packet>`` elements, so
+    writing a batch never blocks on an unread stdout. With ``keep``, only
+    the lines it matches are kept from each packet, as they are read.
+    """
+
+    def __init__(self, cmd, keep=None):
+        self._keep = keep
+        self._proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._packets = queue.Queue()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+        self._proc.stdin.write(PCAP_HEADER)
+
+    def _read(self):
+        packet = None
+        for line in self._proc.stdout:
+            line = line.decode(errors="replace")
+            if packet is None:
+                if "<packet>" in line:
+                    packet = [line] if self._keep is None else []
+                continue
+            if "</packet>" in line:
+                if self._keep is None:
+                    packet.append(line)
+                self._packets.put("".join(packet))
+                packet = None
+            elif self._keep is None or self._keep.search(line):
+                packet.append(line)
+        self._packets.put(None)
+
+    def decode(self, payloads: List[bytes]) -> List[str]:
+        with self._lock:
+            self._proc.stdin.write(b"".join(pcap_record(p) for p in payloads))
+            self._proc.stdin.flush()
+            result = []
+            for _ in payloads:
+                packet = self._packets.get()
+                if packet is None:
+                    raise RuntimeError(f"decoder exited: {self._proc.args}")
+                result.append(packet)
+            return result
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+        self._reader.join()
+
+
+class L3Cache:
+    """Decode results keyed on (DLT, hex payload, fulldecode).
+
+    Entries live in an LRU capped at ``max_bytes`` of payload and result
+    text. With ``path`` they are also kept in a sqlite file, which worker
+    processes and later runs share; the in-memory part is per process.
+    """
+
+    ENTRY_OVERHEAD = 100
+
+    def __init__(self, max_bytes: int = 256 * 2 ** 20, path: str = None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, str, bool], str]" = OrderedDict()
+        self._size = 0
+        self._db = None
+        self._pid = None
+
+    @staticmethod
+    def _entry_size(key, value) -> int:
+        return len(key[1]) + len(value) + L3Cache.ENTRY_OVERHEAD
+
+    def _connection(self):
+        if self.path is None:
+            return None
+        if self._pid != os.getpid():
+            # connections are not inherited by forked workers
+            self._db = sqlite3.connect(self.path, timeout=60)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS l3 (dlt TEXT, payload TEXT, full INTEGER,"
+                " result TEXT, PRIMARY KEY (dlt, payload, full))"
+            )
+            self._pid = os.getpid()
+        return self._db
+
+    def _remember(self, key, value):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = value
+        self._size += self._entry_size(key, value)
+        while self._size > self.max_bytes and self._entries:
+            old_key, old_value = self._entries.popitem(last=False)
+            self._size -= self._entry_size(old_key, old_value)
+
+    def get(self, key: Tuple[str, str, bool]) -> Optional[str]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+        db = self._connection()
+        if db is not None:
+            row = db.execute(
+                "SELECT result FROM l3 WHERE dlt=? AND payload=? AND full=?", key
+            ).fetchone()
+            if row is not None:
+                self._remember(key, row[0])
+                self.hits += 1
+                return row[0]
+        self.misses += 1
+        return None
+
+    def put_many(self, items: Dict[Tuple[str, str, bool], str]):
+        for key, value in items.items():
+            self._remember(key, value)
+        db = self._connection()
+        if db is not None and items:
+            with db:
+                db.executemany(
+                    "INSERT OR IGNORE INTO l3 VALUES (?, ?, ?, ?)",
+                    [key + (value,) for key, value in items.items()],
+                )
+
+    def stats(self) -> Dict[str, int]:
+        return {"l3_cache_hits": self.hits, "l3_cache_misses": self.misses}
+
+
+class L3Decoder:
+    """Decodes L3 payloads with a few long-lived tshark processes per DLT.
+
+    Messages are grouped by DLT and sent in batches through one pcap stream
+    per process; the PDML output is split back per message. Without
+    ``fulldecode`` only the lines mentioning ``L3_LOOK_FOR`` are kept while
+    reading it, as the former ``grep`` stage did. ``command`` may point at a
+    stand-in for tshark, ``{dlt}`` in it is replaced by the dissector name.
+    With a ``cache``, each distinct payload is only decoded once.
+    """
+
+    re_look_for = re.compile("|".join(L3_LOOK_FOR), re.IGNORECASE)
+
+    def __init__(
+        self,
+        dlts: Dict[str, str],
+        fulldecode: bool = False,
+        procs_per_dlt: int = 2,
+        batch_size: int = 1000,
+        command=TSHARK_CMD,
+        cache: L3Cache = None,
+    ):
+        self.dlts = dlts
+        self.cache = cache
+        self.fulldecode = fulldecode
+        self.procs_per_dlt = procs_per_dlt
+        self.batch_size = batch_size
+        self.command = command
+        self._procs: Dict[str, List[DecoderProcess]] = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def dlt(self, msg: Message) -> str:
+        return self.dlts.get(msg.name, "s1ap") if "X2" not in msg.name else "x2ap"
+
+    def _processes(self, dlt: str) -> List[DecoderProcess]:
+        if dlt not in self._procs:
+            cmd = [arg.replace("{dlt}", dlt) for arg in self.command]
+            keep = None if self.fulldecode else self.re_look_for
+            self._procs[dlt] = [
+                DecoderProcess(cmd, keep) for _ in range(self.procs_per_dlt)
+            ]
+        return self._procs[dlt]
+
+    def _decode_slice(self, proc: DecoderProcess, payloads: List[bytes]):
+        result = []
+        for pos in range(0, len(payloads), self.batch_size):
+            result.extend(proc.decode(payloads[pos : pos + self.batch_size]))
+        return result
+
+    def decode(self, msgs: List[Message]) -> List[Optional[str]]:
+        """Decoded text per message, None for messages without L3."""
+        result: List[Optional[str]] = [None] * len(msgs)
+        # key -> positions of the messages waiting for it
+        pending: Dict[Tuple[str, str, bool], List[int]] = {}
+        for pos, msg in enumerate(msgs):
+            if not msg.has_l3:
+                continue
+            key = (self.dlt(msg), msg.l3, self.fulldecode)
+            if key in pending:
+                pending[key].append(pos)
+                continue
+            cached = self.cache.get(key) if self.cache is not None else None
+            if cached is not None:
+                result[pos] = cached
+            else:
+                pending[key] = [pos]
+        by_dlt: Dict[str, list] = {}
+        for key in pending:
+            by_dlt.setdefault(key[0], []).append(key)
+        jobs = []
+        for dlt, keys in by_dlt.items():
+            procs = self._processes(dlt)
+            step = -(-len(keys) // len(procs))
+            for nb, proc in enumerate(procs):
+                part = keys[nb * step : (nb + 1) * step]
+                if part:
+                    jobs.append((part, proc, [l3_bytes(key[1]) for key in part]))
+        if not jobs:
+            return result
+        decoded = {}
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [
+                (part, executor.submit(self._decode_slice, proc, payloads))
+                for part, proc, payloads in jobs
+            ]
+            for part, future in futures:
+                decoded.update(zip(part, future.result()))
+        for key, value in decoded.items():
+            for pos in pending[key]:
+                result[pos] = value
+        if self.cache is not None:
+            self.cache.put_many(decoded)
+        return result
+
+    def close(self):
+        for procs in self._procs.values():
+            for proc in procs:
+                proc.close()
+        self._procs = {}
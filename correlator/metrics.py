@@ -0,0 +1,196 @@
+import functools
+import itertools
+import json
+import resource
+import time
+
+__all__ = ["NULL_PROFILER", "NullProfiler", "Profiler"]
+
+# items ``Profiler.iterate()`` pulls per timed step
+BATCH = 1000
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    # kB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "path", "items", "wall", "cpu")
+
+    def __init__(self, profiler, name: str, items: int = 0):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.path = self.profiler._enter(self.name)
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self.path, self.wall, self.cpu, self.items, rss=True)
+
+
+class Profiler:
+    """Wall time, CPU time, items and peak RSS of the pipeline stages.
+
+    Stages nest: one entered while another runs is recorded under its path,
+    e.g. ``input;filter;parse;read`` when messages are pulled through
+    generators wrapped with ``iterate()``. Self times leave out the nested
+    stages, ``report()`` lists both and folded stacks of the self wall times
+    for flame graph tools. Shards correlated in other processes report
+    their own times, kept apart in ``shards``.
+    """
+
+    enabled = True
+
+    def __init__(self):
+        # path -> [calls, items, wall, cpu, nested wall, nested cpu, peak RSS]
+        self._stats = {}
+        self._stack = []
+        self.shards = []
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+
+    def _record(self, path: str):
+        stats = self._stats.get(path)
+        if stats is None:
+            stats = self._stats[path] = [0, 0, 0.0, 0.0, 0.0, 0.0, 0.0]
+        return stats
+
+    def _enter(self, name: str) -> str:
+        path = f"{self._stack[-1]};{name}" if self._stack else name
+        self._stack.append(path)
+        return path
+
+    def _exit(self, path: str, wall: float, cpu: float, items: int, rss=False):
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        self._stack.pop()
+        stats = self._record(path)
+        stats[0] += 1
+        stats[1] += items
+        stats[2] += wall
+        stats[3] += cpu
+        if rss:
+            stats[6] = max(stats[6], peak_rss_mb())
+        if self._stack:
+            parent = self._record(self._stack[-1])
+            parent[4] += wall
+            parent[5] += cpu
+
+    def stage(self, name: str, items: int = 0) -> _Stage:
+        """Context manager timing a stage, set ``items`` on what it returns."""
+        return _Stage(self, name, items)
+
+    def iterate(self, name: str, iterable, batch: int = BATCH):
+        """Yields the items of ``iterable``, timing the steps as ``name``
+        ``batch`` items at a time, so that timing costs little next to
+        them."""
+        iterator = iter(iterable)
+        while True:
+            path = self._enter(name)
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                items = list(itertools.islice(iterator, batch))
+            except BaseException:
+                self._exit(path, wall, cpu, 0)
+                raise
+            last = len(items) < batch
+            self._exit(path, wall, cpu, len(items), rss=last)
+            yield from items
+            if last:
+                return
+
+    def wrap(self, name: str, func):
+        """``func`` timed as ``name``, one item per call."""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            path = self._enter(name)
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit(path, wall, cpu, 1)
+
+        return wrapper
+
+    def add_shards(self, shards):
+        self.shards.extend(shards)
+
+    def report(self) -> dict:
+        stages = []
+        folded = []
+        for path, (calls, items, wall, cpu, sub_wall, sub_cpu, rss) in sorted(
+            self._stats.items()
+        ):
+            stages.append(
+                {
+                    "stage": path,
+                    "calls": calls,
+                    "items": items,
+                    "wall_s": round(wall, 6),
+                    "self_wall_s": round(wall - sub_wall, 6),
+                    "cpu_s": round(cpu, 6),
+                    "self_cpu_s": round(cpu - sub_cpu, 6),
+                    "items_per_sec": round(items / wall, 1) if wall else None,
+                    "peak_rss_mb": round(rss, 1) if rss else None,
+                }
+            )
+            folded.append(f"{path} {max(0, int((wall - sub_wall) * 1e6))}")
+        return {
+            "wall_s": round(time.perf_counter() - self._wall, 6),
+            "cpu_s": round(time.process_time() - self._cpu, 6),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "children_peak_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+            "stages": stages,
+            "shards": self.shards,
+            # self wall time in microseconds, as flamegraph.pl reads them
+            "folded": folded,
+        }
+
+    def save(self, path):
+        with open(path, "w") as file_hnd:
+            json.dump(self.report(), file_hnd, indent=2)
+            file_hnd.write("\n")
+
+
+class _NullStage:
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+class NullProfiler:
+    """Stands in for ``Profiler`` when profiling is off: generators and
+    functions are handed back as they are, stages cost one call."""
+
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name: str, items: int = 0) -> _NullStage:
+        return self._stage
+
+    def iterate(self, name: str, iterable, batch: int = BATCH):
+        return iterable
+
+    def wrap(self, name: str, func):
+        return func
+
+    def add_shards(self, shards):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
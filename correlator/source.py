@@ -0,0 +1,143 @@
+import atexit
+import gzip
+import mmap
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+
+__all__ = ["MappedFile"]
+
+
+class MappedFile:
+    """Read-only memory mapping of a decoded trace file.
+
+    Messages parsed from it keep only the byte span of their body and read
+    the text back on demand. ``.gz`` input is decompressed once to a
+    temporary file which is mapped instead. Instances are shared per process
+    and pickle by path, so messages sent to workers reopen the mapping there.
+    """
+
+    _opened = {}
+
+    def __init__(self, path: pathlib.Path, origin: pathlib.Path = None):
+        self.path = pathlib.Path(path)
+        self.origin = pathlib.Path(origin) if origin else self.path
+        with open(self.path, "rb") as file_hnd:
+            if os.fstat(file_hnd.fileno()).st_size == 0:
+                self.buffer = b""
+            else:
+                self.buffer = mmap.mmap(
+                    file_hnd.fileno(), 0, access=mmap.ACCESS_READ
+                )
+
+    @classmethod
+    def open(cls, path, origin=None):
+        path = pathlib.Path(path)
+        if path not in cls._opened:
+            if path.suffix == ".gz":
+                with tempfile.NamedTemporaryFile(
+                    prefix=path.stem + ".", delete=False
+                ) as tmp, gzip.open(path, "rb") as gz_hnd:
+                    shutil.copyfileobj(gz_hnd, tmp)
+                atexit.register(os.unlink, tmp.name)
+                cls._opened[path] = cls(tmp.name, origin=path)
+                cls._opened[pathlib.Path(tmp.name)] = cls._opened[path]
+            else:
+                cls._opened[path] = cls(path, origin=origin)
+        return cls._opened[path]
+
+    def __reduce__(self):
+        return (MappedFile.open, (str(self.path), str(self.origin)))
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def text(self, start: int, end: int) -> str:
+        return self.buffer[start:end].decode()
+
+    def chunks(self, re_msg_nm, size: int):
+        """(start, end) ranges of about ``size`` bytes covering the file.
+
+        Every range but the first starts at a message header line, so that
+        ``spans()`` over the ranges yields each message exactly once.
+        """
+        buf = self.buffer
+        re_header = re.compile(re_msg_nm.pattern.encode())
+        result = [0]
+        pos = size
+        while pos < len(buf):
+            brace = buf.find(b"{", pos)
+            if brace == -1:
+                break
+            line_start = buf.rfind(b"\n", 0, brace) + 1
+            if line_start < pos or not re_header.match(buf, line_start):
+                pos = brace + 1
+                continue
+            result.append(line_start)
+            pos = line_start + size
+        result.append(len(buf))
+        return list(zip(result, result[1:]))
+
+    def spans(self, re_msg_nm, start: int = 0, end: int = None):
+        """Byte spans of message bodies whose header starts in [start, end).
+
+        A body runs from its header line up to, not including, the first
+        line holding the closing bound, the same lines ``from_text`` keeps.
+        """
+        buf = self.buffer
+        re_header = re.compile(re_msg_nm.pattern.encode())
+        end = len(buf) if end is None else end
+        pos = start
+        while pos < end:
+            brace = buf.find(b"{", pos)
+            if brace == -1:
+                return
+            line_start = buf.rfind(b"\n", 0, brace) + 1
+            if line_start >= end:
+                return
+            if line_start < pos or not re_header.match(buf, line_start):
+                pos = brace + 1
+                continue
+            close = buf.find(b"}", brace + 1)
+            if close == -1:
+                close = len(buf)
+            # a header before the closing bound restarts the body
+            brace = buf.find(b"{", brace + 1, close)
+            while brace != -1:
+                header = buf.rfind(b"\n", 0, brace) + 1
+                if re_header.match(buf, header):
+                    line_start = header
+                brace = buf.find(b"{", brace + 1, close)
+            if line_start >= end:
+                # restarted in the next range, which yields it
+                return
+            if close == len(buf):
+                yield line_start, close
+                return
+            yield line_start, buf.rfind(b"\n", 0, close) + 1
+            pos = close + 1
+
+    def messages(
+        self,
+        Message_,
+        l3: bool = False,
+        start: int = 0,
+        end: int = None,
+        keep_text: bool = False,
+        prefilter=None,
+    ):
+        """Parsed messages of ``spans()``. With ``keep_text`` they hold their
+        body as text instead of a span, e.g. to outlive the mapping. Bodies
+        ``prefilter`` rejects, see ``Message.prefilter()``, are not parsed."""
+        for span in self.spans(Message_.re_msg_nm, start, end):
+            if prefilter is not None and not prefilter(self.buffer, *span):
+                continue
+            msg = Message_()
+            if keep_text:
+                found = msg.from_text(self.text(*span).splitlines(True), l3=l3)
+            else:
+                found = msg.from_span(self, *span, l3=l3)
+            if found:
+                yield msg
@@ -0,0 +1,138 @@
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from .classes import XDR
+
+__all__ = ["XDRStore"]
+
+# key fields of all XDR classes, the columns XDRs are looked up on
+KEY_COLUMNS = ("tmsi", "gci", "enbid", "trsr", "crnti", "rncmodid", "ueid", "rncid")
+INDEXES = {
+    "tmsi": ("tmsi", "ts_begin"),
+    "gci": ("gci", "ts_begin"),
+    "enb": ("enbid", "trsr"),
+    "crnti": ("crnti",),
+    "ue": ("rncmodid", "ueid"),
+    "scenario": ("scenario", "ts_begin"),
+    "time": ("ts_begin", "ts_end"),
+}
+
+
+class XDRStore:
+    """Correlated XDRs kept in a sqlite file, for lookups across runs.
+
+    One row per XDR: its tmsi, key fields, scenario number, time range and
+    text as printed, each lookup column indexed. Runs add their XDRs by
+    batches, ``query()`` finds them again without the traces. Times are
+    the ``ts`` of the messages: ms since the epoch for 3G, ms since the
+    midnight starting the run for 4G, past ``DAY_MS`` on the next day.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, batch_size: int = 1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.run_id = None
+        self._rows: List[tuple] = []
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY,"
+                " version INTEGER, started REAL, files TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS xdrs (id INTEGER PRIMARY KEY,"
+                " run INTEGER, tech TEXT, ts_begin INTEGER, ts_end INTEGER,"
+                " scenario INTEGER, "
+                + ", ".join(f"{key} INTEGER" for key in KEY_COLUMNS)
+                + ", text TEXT)"
+            )
+            for name, columns in INDEXES.items():
+                self._db.execute(
+                    f"CREATE INDEX IF NOT EXISTS xdrs_{name} ON xdrs"
+                    f" ({', '.join(columns)})"
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start_run(self, files: List[str]):
+        """Run the XDRs added next belong to."""
+        with self._db:
+            cursor = self._db.execute(
+                "INSERT INTO runs (version, started, files) VALUES (?, ?, ?)",
+                (self.VERSION, time.time(), "\n".join(files)),
+            )
+        self.run_id = cursor.lastrowid
+
+    def add(self, xdr: XDR, scenario: int):
+        self._rows.append(
+            (
+                self.run_id,
+                type(xdr).__name__,
+                xdr.ts_begin,
+                xdr.ts_end,
+                scenario,
+                *(getattr(xdr, key, None) for key in KEY_COLUMNS),
+                str(xdr),
+            )
+        )
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO xdrs (run, tech, ts_begin, ts_end, scenario, "
+                + ", ".join(KEY_COLUMNS)
+                + ", text) VALUES ("
+                + ", ".join("?" * (6 + len(KEY_COLUMNS)))
+                + ")",
+                self._rows,
+            )
+        self._rows = []
+
+    def query(
+        self,
+        xdr_class=None,
+        filters: Dict[str, int] = None,
+        ts_from: int = None,
+        ts_to: int = None,
+    ) -> Iterator[Tuple[int, int, str]]:
+        """(id, scenario, text) of the stored XDRs with the given key field
+        and ``scenario`` values, overlapping [ts_from, ts_to], in time order."""
+        self.flush()
+        where = []
+        values = []
+        if xdr_class is not None:
+            where.append("tech = ?")
+            values.append(xdr_class.__name__)
+        for key, val in (filters or {}).items():
+            if val is None:
+                continue
+            if key not in KEY_COLUMNS and key != "scenario":
+                raise ValueError(f"no XDR column {key}")
+            where.append(f"{key} = ?")
+            values.append(val)
+        if ts_from is not None:
+            where.append("ts_end >= ?")
+            values.append(ts_from)
+        if ts_to is not None:
+            where.append("ts_begin <= ?")
+            values.append(ts_to)
+        sql = "SELECT id, scenario, text FROM xdrs"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        yield from self._db.execute(sql + " ORDER BY ts_begin, id", values)
+
+    def close(self):
+        self.flush()
+        self._db.close()
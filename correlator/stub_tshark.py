@@ -0,0 +1,39 @@
+"""Stand-in for tshark in tests and benchmarks.
+
+Reads a pcap stream on stdin like ``tshark -l -T pdml -r -`` and writes one
+PDML ``<packet>`` per record as soon as it is read. The fields echo the
+dissector name given on the command line and the payload, the last four
+payload bytes are reported as an m-TMSI.
+
+    python stub_tshark.py DLT
+"""
+import struct
+import sys
+
+
+def main(args):
+    dlt = args[0] if args else "s1ap"
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout
+    stdin.read(24)
+    stdout.write('<?xml version="1.0"?>\n<pdml version="0" creator="stub">\n')
+    while True:
+        header = stdin.read(16)
+        if len(header) < 16:
+            break
+        _, _, incl_len, _ = struct.unpack("<IIII", header)
+        payload = stdin.read(incl_len).hex()
+        stdout.write(
+            "<packet>\n"
+            f'  <proto name="{dlt}" showname="{dlt}">\n'
+            f'    <field name="{dlt}.payload" value="{payload}"/>\n'
+            f'    <field name="nas_eps.emm.m_tmsi" value="{payload[-8:]}"/>\n'
+            "  </proto>\n"
+            "</packet>\n"
+        )
+        stdout.flush()
+    stdout.write("</pdml>\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
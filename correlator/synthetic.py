@@ -0,0 +1,260 @@
+"""Synthetic decoded traces, for benchmarks.
+
+UE sessions start at random on a set of cells and run concurrently, each a
+call flow of messages spread over an exponentially distributed length.
+Messages of all sessions are written in time order, give or take a few
+late ones. Some sessions end with an X2 handover, some messages carry a
+``NULL_ENB`` eNB id and can only be matched on their C-RNTI.
+
+    python -m correlator.synthetic -g 4G --size-mb 100 trace.txt
+"""
+import argparse
+import heapq
+import random
+from datetime import datetime, timedelta
+
+from .classes import DAY_MS, NULL_ENB, XDR3G
+
+__all__ = ["Profile", "write_trace"]
+
+FLOW_4G = (
+    "RRC_RRC_CONNECTION_REQUEST",
+    "RRC_RRC_CONNECTION_SETUP_COMPLETE",
+    "S1_INITIAL_UE_MESSAGE",
+    "S1_INITIAL_CONTEXT_SETUP_REQUEST",
+    "RRC_UE_CAPABILITY_ENQUIRY",
+    "RRC_UE_CAPABILITY_INFORMATION",
+    "S1_INITIAL_CONTEXT_SETUP_RESPONSE",
+    "RRC_RRC_CONNECTION_RECONFIGURATION",
+    "RRC_RRC_CONNECTION_RECONFIGURATION_COMPLETE",
+)
+END_4G = ("S1_UE_CONTEXT_RELEASE_COMMAND", "RRC_RRC_CONNECTION_RELEASE")
+PERIODIC_4G = "INTERNAL_PER_RADIO_UE_MEASUREMENT_TA"
+HANDOVER_4G = "X2_HANDOVER_REQUEST"
+
+FLOW_3G = (
+    "RRC_CONNECTION_REQUEST",
+    "NBAP_RADIO_LINK_SETUP_REQUEST",
+    "RRC_CONNECTION_SETUP_COMPLETE",
+    "RANAP_INITIAL_UE_MESSAGE",
+    "RANAP_RAB_ASSIGNMENT_REQUEST",
+)
+END_3G = ("RANAP_IU_RELEASE_COMMAND", "RRC_CONNECTION_RELEASE")
+PERIODIC_3G = "INTERNAL_SOFT_HANDOVER_EXECUTION"
+HANDOVER_3G = "RANAP_RELOCATION_REQUEST"
+
+
+class Profile:
+    """Shape of a synthetic trace.
+
+    ``session_s`` is the mean session length, ``periodic_s`` the mean gap
+    between measurement reports within a session. ``x2_rate`` is the share
+    of sessions ending with a handover and ``null_enb_rate`` the share of
+    messages with a ``NULL_ENB`` eNB id (4G only). ``late_rate`` is the share
+    of messages stamped up to ``late_ms`` before ones written earlier.
+    """
+
+    def __init__(
+        self,
+        cells: int = 50,
+        ues: int = 400,
+        session_s: float = 40,
+        periodic_s: float = 5,
+        x2_rate: float = 0.1,
+        null_enb_rate: float = 0.02,
+        crnti_rate: float = 0.6,
+        late_rate: float = 0.05,
+        late_ms: int = 40,
+        start: str = "2020-09-21T06:00:00",
+        seed: int = 0,
+    ):
+        self.cells = cells
+        self.ues = ues
+        self.session_s = session_s
+        self.periodic_s = periodic_s
+        self.x2_rate = x2_rate
+        self.null_enb_rate = null_enb_rate
+        self.crnti_rate = crnti_rate
+        self.late_rate = late_rate
+        self.late_ms = late_ms
+        self.start = start
+        self.seed = seed
+
+
+class _Session:
+    __slots__ = (
+        "cell",
+        "serial",
+        "ue_id",
+        "trsr",
+        "crnti",
+        "tmsi",
+        "steps",
+        "end",
+        "handover",
+    )
+
+    def __init__(
+        self, rnd: random.Random, profile: Profile, serial: int, ts: int, ue_id: int
+    ):
+        self.cell = rnd.randrange(profile.cells)
+        self.serial = serial
+        self.ue_id = ue_id
+        self.trsr = 20000 + serial % 40000
+        # C-RNTIs are not reused while the correlator may still link them
+        self.crnti = 1 + serial % 65000
+        self.tmsi = rnd.getrandbits(32)
+        self.steps = 0
+        self.end = ts + int(rnd.expovariate(1 / profile.session_s) * 1000) + 1000
+        self.handover = rnd.random() < profile.x2_rate
+
+
+class _Writer:
+    def __init__(self, file_hnd, profile: Profile, rnd: random.Random):
+        self.file_hnd = file_hnd
+        self.profile = profile
+        self.rnd = rnd
+        self.serial = 0
+        self.size = 0
+
+    def message(self, name: str, ts: int, session: _Session):
+        lines = [
+            f"[{self.serial}] {name}({self.serial % 4000}) @ {self.stamp(ts)} {{"
+        ]
+        lines.extend(self.fields(name, session))
+        # the stand-in decoder reports the last 4 bytes as the m-TMSI
+        lines.append(
+            f"    L3[SENT]: {self.rnd.getrandbits(64):016x}{session.tmsi:08x}"
+        )
+        lines.append("}\n")
+        text = "\n".join(lines)
+        self.file_hnd.write(text)
+        self.serial += 1
+        self.size += len(text)
+
+
+class _Writer4G(_Writer):
+    flow, end, periodic, handover = FLOW_4G, END_4G, PERIODIC_4G, HANDOVER_4G
+
+    def stamp(self, ts: int) -> str:
+        ts %= DAY_MS
+        return (
+            f"{ts // 3600000:02}:{ts // 60000 % 60:02}:"
+            f"{ts // 1000 % 60:02}.{ts % 1000:03}"
+        )
+
+    def fields(self, name: str, session: _Session):
+        rnd = self.rnd
+        # S1AP ids come back much later, under NULL_ENB
+        enbid = 1 + session.serial % (NULL_ENB - 1)
+        trsr = session.trsr
+        if name == HANDOVER_4G:
+            trsr = NULL_ENB
+        elif rnd.random() < self.profile.null_enb_rate:
+            enbid = NULL_ENB
+        yield "    SCANNER_ID: 0000000000010000000000"
+        yield f"    GLOBAL_CELL_ID: {153800000 + session.cell}"
+        with_enb = not name.startswith("RRC_UE_CAPABILITY") or rnd.random() < 0.5
+        if with_enb:
+            yield f"    ENBS1APID: {enbid}"
+            yield f"    MMES1APID: {120000000 + session.serial}"
+            yield f"    TRACE_RECORDING_SESSION_REFERENCE: {trsr}"
+        if name.startswith("RRC_") and (
+            not with_enb or rnd.random() < self.profile.crnti_rate
+        ):
+            yield f"    CRNTI: {session.crnti} Measure(None, 1.0)"
+
+
+class _Writer3G(_Writer):
+    flow, end, periodic, handover = FLOW_3G, END_3G, PERIODIC_3G, HANDOVER_3G
+
+    def __init__(self, file_hnd, profile: Profile, rnd: random.Random):
+        super().__init__(file_hnd, profile, rnd)
+        self.day = datetime.strptime(profile.start[:10], "%Y-%m-%d")
+
+    def stamp(self, ts: int) -> str:
+        stamp = self.day + timedelta(milliseconds=ts)
+        return stamp.strftime("%Y-%m-%dT%H:%M:%S.") + f"{ts % 1000:03}Z"
+
+    def fields(self, name: str, session: _Session):
+        yield "    scanners: 000000000000000010000000"
+        yield f"    UE_CONTEXT_ID: Some({session.ue_id})"
+        yield f"    RNC_MODULE_ID: Some({session.cell % 8})"
+        yield f"    RNC_ID/CELL_ID[1]: (2241, {30000 + session.cell})"
+        yield "    RNC_ID/CELL_ID[2]: <NA>"
+
+
+def write_trace(file_hnd, size: int, tech: str = "4G", profile: Profile = None):
+    """Writes a decoded trace of about ``size`` bytes of ``tech`` messages.
+    Returns the number of messages written."""
+    profile = profile or Profile()
+    rnd = random.Random(profile.seed)
+    writer = (_Writer4G if tech == "4G" else _Writer3G)(file_hnd, profile, rnd)
+    start = datetime.strptime(profile.start, "%Y-%m-%dT%H:%M:%S")
+    ts = (start - start.replace(hour=0, minute=0, second=0)).seconds * 1000
+    # mean gap between session starts keeping about ``ues`` sessions open
+    arrival_ms = profile.session_s * 1000 / profile.ues
+    # (time, order, session) of the next message of each session
+    events = []
+    sessions = 0
+    next_session = ts
+    # (time, id) of the 3G UE context ids free again: reused once a message
+    # of the new session can no longer join the XDR of the old one
+    free_ue_ids = []
+    ue_ids = 0
+    while writer.size < size:
+        if not events or next_session <= events[0][0]:
+            if free_ue_ids and free_ue_ids[0][0] <= next_session:
+                _, ue_id = heapq.heappop(free_ue_ids)
+            else:
+                ue_id = ue_ids
+                ue_ids += 1
+            session = _Session(rnd, profile, sessions, next_session, ue_id)
+            heapq.heappush(events, (next_session, sessions, session))
+            sessions += 1
+            next_session += int(rnd.expovariate(1 / arrival_ms)) + 1
+            continue
+        ts, order, session = heapq.heappop(events)
+        gap = None
+        if session.steps < len(writer.flow):
+            name = writer.flow[session.steps]
+            gap = rnd.choice((0, 10, 30, 250, 1500))
+        elif ts < session.end:
+            name = writer.periodic
+            gap = int(rnd.expovariate(1 / profile.periodic_s) * 1000) + 1
+        elif session.handover:
+            name = writer.handover
+            session.handover = False
+            gap = rnd.choice((10, 30))
+        else:
+            name = writer.end[order % len(writer.end)]
+            # late messages of the next session are stamped up to late_ms early
+            free = ts + XDR3G.I1 * 1000 + profile.late_ms
+            heapq.heappush(free_ue_ids, (free, session.ue_id))
+        if gap is not None:
+            session.steps += 1
+            heapq.heappush(events, (ts + gap, order, session))
+        if rnd.random() < profile.late_rate:
+            # stamped a little before messages already written
+            ts -= rnd.randrange(1, profile.late_ms)
+        writer.message(name, ts, session)
+    return writer.serial
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="write a synthetic decoded trace")
+    parser.add_argument("file")
+    parser.add_argument("-g", dest="tech", choices=("3G", "4G"), default="4G")
+    parser.add_argument("--size-mb", dest="size_mb", type=float, default=10)
+    parser.add_argument("--cells", dest="cells", type=int, default=50)
+    parser.add_argument("--ues", dest="ues", type=int, default=400)
+    parser.add_argument("--seed", dest="seed", type=int, default=0)
+    parsed = parser.parse_args(args)
+    profile = Profile(cells=parsed.cells, ues=parsed.ues, seed=parsed.seed)
+    with open(parsed.file, "w") as file_hnd:
+        nb = write_trace(file_hnd, int(parsed.size_mb * 2 ** 20), parsed.tech, profile)
+    print(f"{nb} messages written to {parsed.file}")
+
+
+if __name__ == "__main__":
+    main()
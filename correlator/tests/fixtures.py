@@ -1,3 +1,7 @@
+import io
+
+from correlator.synthetic import Profile, write_trace
+
 msg_4g_from_text = [
     """
 }
@@ -141,3 +145,15 @@ d557443d0080fb202d0001005940095000000000ad40010000ee400100000c40120808b187a811fa
     SOURCE_CONF: 25 Measure(None, 1.0)
 """,
 ]
+
+
+def synthetic_4g(nb, seed=0):
+    """Texts of ``nb`` messages of a small, dense 4G trace: two cells, few
+    UEs and C-RNTIs, so that XDRs collide and merge."""
+    trace = io.StringIO()
+    profile = Profile(
+        cells=2, ues=8, x2_rate=0.3, null_enb_rate=0.1, crnti_rate=0.3, seed=seed
+    )
+    # messages are shorter than 400 bytes
+    write_trace(trace, nb * 400, "4G", profile)
+    return [text + "\n}" for text in trace.getvalue().split("\n}\n")[:nb]]
@@ -1,6 +1,55 @@
-from correlator.classes import XDR3G, XDR4G, Message3G, Message4G
+import gzip
+import os
+import pathlib
+import pickle
+import random
+import re
+import sys
+from collections import Counter
 
-from .fixtures import msg_3g_from_text, msg_4g_from_text
+import pytest
+
+from correlator.classes import (FP_SIZE, NULL_ENB, XDR3G, XDR4G, DayClock,
+                                Message3G, Message4G, XDR_scenario)
+from correlator.columns import MessageColumns, build_xdr
+from correlator.engine import Checkpoint, Correlator, Sharder
+from correlator.index import MessageIndex, MessageRows
+from correlator.l3 import L3Cache, L3Decoder
+from correlator.metrics import NULL_PROFILER, Profiler
+from correlator.source import MappedFile
+from correlator.store import XDRStore
+from correlator.synthetic import Profile, write_trace
+
+from .fixtures import msg_3g_from_text, msg_4g_from_text, synthetic_4g
+
+
+def linear_correlate(msgs):
+    """Reference: scan every XDR for every message."""
+    xdrs = []
+    for msg in msgs:
+        matches = [
+            idx
+            for idx, xdr in enumerate(xdrs)
+            if not xdr.is_closed(msg.ts) and xdr.matches(msg)
+        ]
+        if matches:
+            for idx in matches[1:]:
+                xdrs[matches[0]].merge(xdrs[idx])
+            for idx in matches[-1:0:-1]:
+                del xdrs[idx]
+            xdrs[matches[0]].add_msg(msg)
+        else:
+            xdrs.append(XDR4G(msg))
+    return xdrs
+
+
+def parse_4g(texts):
+    result = []
+    for text in texts:
+        msg = Message4G()
+        msg.from_text(text.split("\n"), l3=True)
+        result.append(msg)
+    return result
 
 
 def test_msg_4G_parsing():
@@ -12,6 +61,7 @@ def test_msg_4G_parsing():
     assert msg.enbid == 273678
     assert msg.trsr == 27918
     assert msg.timestamp == "06:48:56.489"
+    assert msg.ts == ((6 * 60 + 48) * 60 + 56) * 1000 + 489
 
 
 def test_msg_3G_parsing():
@@ -23,6 +73,7 @@ def test_msg_3G_parsing():
     assert msg.rncmodid == 0
     assert msg.rncid == 2241
     assert msg.timestamp == "2020-09-21T06:37:59.790Z"
+    assert msg.ts == 1600670279790
 
 
 def test_msg_matches():
@@ -44,6 +95,34 @@ def test_xdr_descr():
     msg_proper.from_text(msg_4g_from_text[2].split("\n"))
     xdr.add_msg(msg_proper)
     assert len(xdr.get_msg_descr()) == 2
+    assert xdr.get_msg_descr() is xdr.get_msg_descr()
+    msg_proper = Message4G()
+    msg_proper.from_text(msg_4g_from_text[4].split("\n"))
+    xdr.add_msg(msg_proper)
+    assert len(xdr.get_msg_descr()) == 3
+
+
+def test_scenario_numbers(tmp_path):
+    path = tmp_path / "scenarios"
+    scenarios = XDR_scenario(path)
+    assert scenarios.scenario_nb({"A", "B"}) == 0
+    assert scenarios.scenario_nb(set()) == 1
+    assert scenarios.scenario_nb(frozenset({"B", "A"})) == 0
+    assert scenarios.scenario_nb({"C"}) == 2
+
+    # another run sharing the file, loaded lazily
+    other = XDR_scenario(path)
+    assert other.scenario_nb(set()) == 1
+    assert other.scenario_nb({"C"}) == 2
+    assert other.scenario_nb({"A", "B"}) == 0
+    assert other.scenario_nb({"D"}) == 3
+    # found by the other run in the meantime
+    assert scenarios.scenario_nb({"E"}) == 4
+    assert scenarios.scenario_nb({"D"}) == 3
+    assert other.scenario_nb({"E"}) == 4
+    lines = path.read_text().splitlines()
+    assert lines[0] == "number,msgs"
+    assert lines[1:] == ["0,A;B", "1,", "2,C", "3,D", "4,E"]
 
 
 def test_xdr_4G_correlation():
@@ -83,3 +162,816 @@ def test_x2_handover():
     assert xdr.matches(x2_msg)
     xdr2 = XDR4G(x2_msg)
     assert xdr2.matches(msg)
+
+
+def test_indexed_correlation_matches_linear_scan():
+    msgs = parse_4g(synthetic_4g(3000, seed=1))
+    expected = linear_correlate(msgs)
+    correlator = Correlator(XDR4G)
+    for msg in msgs:
+        correlator.add(msg)
+    result = correlator.xdrs
+    assert len(result) == len(expected)
+    for xdr, ref in zip(result, expected):
+        assert [id(m) for m in xdr.messages] == [id(m) for m in ref.messages]
+        assert repr(xdr) == repr(ref)
+
+
+def test_correlator_expires_closed_xdrs():
+    msgs = parse_4g(synthetic_4g(3000, seed=2))
+    expected = linear_correlate(msgs)
+    correlator = Correlator(XDR4G, 60)
+    finished = []
+    live = 0
+    for msg in msgs:
+        correlator.add(msg)
+        finished.extend(correlator.drain())
+        live = max(live, len(correlator))
+    finished.extend(correlator.flush())
+    assert len(correlator) == 0
+    assert live < len(expected) / 4
+    assert sorted(repr(xdr) for xdr in finished) == sorted(
+        repr(xdr) for xdr in expected
+    )
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_batch_correlation_keeps_late_messages(engine):
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+    import decoded_corr
+
+    # the third message comes 3 minutes behind the stream time, yet within
+    # T1 of the first one
+    msgs = []
+    for nb, (second, enbid) in enumerate(((0, 7), (210, 8), (30, 7))):
+        msg = Message4G()
+        msg.name = "RRC_A"
+        msg.ts = 36000000 + 1000 * second
+        msg.gci, msg.enbid, msg.trsr, msg.crnti = 1, enbid, 20, None
+        msg.fp = bytes([nb]) * FP_SIZE
+        msgs.append(msg)
+    expected = [
+        [msgs.index(msg) for msg in xdr.messages] for xdr in linear_correlate(msgs)
+    ]
+    assert expected == [[0, 2], [1]]
+    xdrs, _, _ = decoded_corr.correlate(
+        XDR4G, MessageColumns(Message4G, msgs), engine=engine
+    )
+    assert xdrs == expected
+    # while streaming, the first XDR is closed by then
+    correlator = Correlator(XDR4G, 60)
+    for msg in msgs:
+        correlator.add(msg)
+    assert len(correlator.flush()) == 3
+
+
+def test_stream_correlation_emits_all_xdrs():
+    import decoded_corr
+
+    msgs = parse_4g(synthetic_4g(2000, seed=3))
+    expected = linear_correlate(msgs)
+    emitted = []
+    stats = decoded_corr.correlate_stream(msgs, XDR4G, emitted.append)
+    assert stats["msgs"] == len(msgs)
+    assert sorted(repr(xdr) for xdr in emitted) == sorted(
+        repr(xdr) for xdr in expected
+    )
+
+
+def dying_worker(*args):
+    os._exit(3)
+
+
+def test_stream_correlation_stops_on_failed_worker(monkeypatch):
+    import decoded_corr
+
+    # same crnti, the second one with a NULL_ENB enbid and another trsr
+    msgs = []
+    for nb, (enbid, trsr) in enumerate(((7, 20), (None, 21))):
+        msg = Message4G()
+        msg.name = "RRC_A"
+        msg.ts = 1000 * nb
+        msg.gci, msg.enbid, msg.trsr, msg.crnti = 1, enbid, trsr, 100
+        msg.fp = bytes([nb]) * FP_SIZE
+        msgs.append(msg)
+    with pytest.raises(AssertionError) as info:
+        decoded_corr.correlate_stream(msgs, XDR4G, lambda xdr: None)
+    assert isinstance(info.value.__cause__, decoded_corr.WorkerError)
+    assert "add_msg" in str(info.value.__cause__)
+
+    # a worker gone without a word, while its queue is full
+    monkeypatch.setattr(decoded_corr, "correlation_worker", dying_worker)
+    monkeypatch.setattr(decoded_corr, "STREAM_BATCH", 1)
+    monkeypatch.setattr(decoded_corr, "STREAM_QUEUE_SIZE", 1)
+    monkeypatch.setattr(decoded_corr, "WORKER_POLL", 0.1)
+    with pytest.raises(decoded_corr.WorkerError):
+        decoded_corr.correlate_stream(msgs * 20, XDR4G, lambda xdr: None)
+
+
+def regexp_fields(msg_class, text, value_re):
+    """Reference: every key field regexp searched on every line."""
+    result = {}
+    for line in text.split("\n"):
+        for key, field in msg_class.key_fields.items():
+            mo = re.search(rf"\W+{re.escape(field['tag'])}:{value_re}", line)
+            if mo and not (key in ("enbid", "trsr") and int(mo.group(1)) == NULL_ENB):
+                result[key] = int(mo.group(1))
+    return result
+
+
+def test_single_pass_parser_fields():
+    cases = [(Message4G, text, r"\W([\d]+)") for text in msg_4g_from_text[1:]]
+    cases += [
+        (Message4G, text, r"\W([\d]+)") for text in synthetic_4g(300, seed=4)
+    ]
+    cases += [(Message3G, text, r"\W[^\(]*\(([\d]+)") for text in msg_3g_from_text]
+    for msg_class, text, value_re in cases:
+        msg = msg_class()
+        msg.from_text(text.split("\n"), l3=True)
+        expected = regexp_fields(msg_class, text.split("}")[0], value_re)
+        for key in msg_class.key_fields:
+            assert getattr(msg, key) == expected.get(key)
+        assert (msg.l3 is not None) == ("L3[" in text)
+        assert msg.body.startswith("[")
+
+
+def test_mapped_messages_match_text_parsing(tmp_path):
+    text = "\n".join(msg_4g_from_text + synthetic_4g(200, seed=5)) + "\n"
+    path = tmp_path / "trace.txt"
+    path.write_text(text)
+    gz_path = tmp_path / "trace.txt.gz"
+    with gzip.open(gz_path, "wt") as gz_hnd:
+        gz_hnd.write(text)
+    with open(path) as file_hnd:
+        expected = []
+        msg = Message4G()
+        while msg.from_text(file_hnd, l3=True):
+            expected.append(msg)
+            msg = Message4G()
+    for in_file in (path, gz_path):
+        msgs = list(MappedFile.open(in_file).messages(Message4G, l3=True))
+        assert [str(m) for m in msgs] == [str(m) for m in expected]
+        assert [m.body for m in msgs] == [m.body for m in expected]
+        assert [m.l3 for m in msgs] == [m.l3 for m in expected]
+        assert all(m.text is None for m in msgs)
+        assert pickle.loads(pickle.dumps(msgs[3])).body == expected[3].body
+        # the timestamp and L3 payload are spans of the mapping too
+        msg = msgs[3]
+        assert not isinstance(msg._timestamp, str) and not isinstance(msg._l3, str)
+        assert msg.has_l3 and not Message4G().has_l3
+        msg.detach()
+        assert (msg.timestamp, msg.l3) == (expected[3].timestamp, expected[3].l3)
+        assert isinstance(msg._timestamp, str) and isinstance(msg._l3, str)
+
+
+def test_keyless_message_is_skipped_by_all_readers(tmp_path):
+    import decoded_corr
+
+    keyless = "\n".join(
+        line
+        for line in msg_4g_from_text[2].split("\n")
+        if "GLOBAL_CELL_ID" not in line
+    )
+    texts = msg_4g_from_text[1:] + synthetic_4g(200, seed=4)
+    path = tmp_path / "trace.txt"
+    path.write_text("\n".join(texts[:50] + [keyless] + texts[50:]) + "\n")
+    expected = [str(msg) for msg in parse_4g(texts)]
+    by_lines = decoded_corr.read_messages(path, Message4G)
+    mapped = decoded_corr.read_messages(path, Message4G, mapped=True)
+    chunked = (
+        msg
+        for _, msgs in decoded_corr.parse_files([path], Message4G, 2, 3000)
+        for msg in msgs
+    )
+    for msgs in (by_lines, mapped, chunked):
+        assert [str(msg) for msg in msgs] == expected
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {"gci": 153800001},
+        {"enbid": 2, "crnti": 2},
+        {"trsr": 20003},
+        {"trsr": 8388608},
+        {"crnti": 2799, "ueid": 4},
+        {"gci": 1},
+    ],
+)
+def test_prefilter_rejects_only_unmatched(tmp_path, filters):
+    text = "\n".join(msg_4g_from_text + synthetic_4g(300, seed=6)) + "\n"
+    path = tmp_path / "trace.txt"
+    path.write_text(text)
+    source = MappedFile.open(path)
+    msgs = list(source.messages(Message4G))
+    kept = list(source.messages(Message4G, prefilter=Message4G.prefilter(filters)))
+    assert len(kept) < len(msgs)
+    assert [msg.span for msg in kept if msg.matches(**filters)] == [
+        msg.span for msg in msgs if msg.matches(**filters)
+    ]
+    assert Message4G.prefilter({"gci": None, "ueid": 4}) is None
+
+
+def test_compact_objects():
+    msg = Message4G()
+    msg.from_text(msg_4g_from_text[2].split("\n"))
+    xdr = XDR4G(msg)
+    msg_3g = Message3G()
+    msg_3g.from_text(msg_3g_from_text[0].split("\n"))
+    for item in (msg, xdr, msg_3g, XDR3G(msg_3g)):
+        assert not hasattr(item, "__dict__")
+    assert msg.key_field == "gci" and msg.cardinal_field_val == 153813763
+    assert pickle.loads(pickle.dumps(xdr)).messages[0].body == msg.body
+
+
+STUB_DECODER = (
+    sys.executable,
+    str(pathlib.Path(__file__).parent.parent / "stub_tshark.py"),
+    "{dlt}",
+)
+
+
+def test_l3_decoder_batches():
+    msgs = parse_4g(msg_4g_from_text[1:] + synthetic_4g(50, seed=6))
+    msgs[3].l3 = None
+    dlts = {"RRC_UE_CAPABILITY_ENQUIRY": "lte-rrc.dl.dcch"}
+    with L3Decoder(dlts, fulldecode=True, batch_size=7, command=STUB_DECODER) as dec:
+        full = dec.decode(msgs)
+    assert full[3] is None
+    assert sum(meta is not None for meta in full) == len(msgs) - 1
+    for msg, meta in zip(msgs, full):
+        if msg.l3 is not None:
+            assert f'value="{msg.l3}"' in meta
+            assert f'name="{dec.dlt(msg)}"' in meta
+    with L3Decoder(dlts, command=STUB_DECODER) as dec:
+        short = dec.decode(msgs[:3])
+    assert short[0].strip().startswith('<field name="nas_eps.emm.m_tmsi"')
+    assert short[0].count("\n") == 1
+
+
+def test_l3_decoded_once_by_message(tmp_path):
+    import decoded_corr
+
+    path = tmp_path / "trace.txt"
+    with open(path, "w") as file_hnd:
+        write_trace(file_hnd, 40000, "4G", Profile(cells=5, ues=20, seed=2))
+
+    def correlated():
+        correlator = Correlator(XDR4G)
+        for msg in decoded_corr.read_messages(path, Message4G, l3=True):
+            correlator.add(msg)
+        return correlator.flush()
+
+    eager = correlated()
+    lazy = correlated()
+    eager_counters = Counter()
+    lazy_counters = Counter()
+    with L3Decoder({}, command=STUB_DECODER) as dec:
+        decode_xdrs = decoded_corr.decode_xdrs
+        decode_xdrs(dec, eager, eager_counters)
+        decode_xdrs(dec, lazy, lazy_counters, XDR4G.meta_names())
+        assert [xdr.tmsi for xdr in lazy] == [xdr.tmsi for xdr in eager]
+        assert lazy_counters["l3_msgs"] < eager_counters["l3_msgs"]
+        decode_xdrs(dec, lazy, lazy_counters)
+        decode_xdrs(dec, lazy, lazy_counters)
+    assert lazy_counters["l3_msgs"] == eager_counters["l3_msgs"]
+    assert [xdr.metas for xdr in lazy] == [xdr.metas for xdr in eager]
+    assert any(xdr.tmsi is not None for xdr in eager)
+
+
+def test_l3_cache(tmp_path):
+    cache = L3Cache(max_bytes=3 * (L3Cache.ENTRY_OVERHEAD + 4))
+    for nb in range(4):
+        cache.put_many({("s1ap", f"{nb:02}", False): "ab"})
+    assert cache.get(("s1ap", "00", False)) is None
+    assert cache.get(("s1ap", "03", False)) == "ab"
+    assert cache.stats() == {"l3_cache_hits": 1, "l3_cache_misses": 1}
+
+    msgs = parse_4g(msg_4g_from_text[1:] * 3)
+    path = str(tmp_path / "l3.sqlite")
+    with L3Decoder({}, cache=L3Cache(path=path), command=STUB_DECODER) as dec:
+        first = dec.decode(msgs)
+        assert dec.decode(msgs) == first
+        assert dec.cache.misses == len(msg_4g_from_text) - 1
+    with L3Decoder({}, cache=L3Cache(path=path), command=("false",)) as dec:
+        assert dec.decode(msgs) == first
+        assert dec.cache.misses == 0
+
+
+def test_timestamps_across_midnight():
+    day = 24 * 3600 * 1000
+    clock = DayClock()
+    stamps = [day - 2000, day - 1000, 500, day - 1500, 1500]
+    assert [clock(ts) for ts in stamps] == [
+        day - 2000,
+        day - 1000,
+        day + 500,
+        day - 1500,
+        day + 1500,
+    ]
+
+    xdr = XDR4G(parse_4g(msg_4g_from_text[:1])[0])
+    assert xdr.format_ts(xdr.ts_begin) == "06:48:56.489000"
+    assert xdr.format_ts(xdr.ts_begin + day) == "06:48:56.489000"
+    msg = Message3G()
+    msg.from_text(msg_3g_from_text[2].split("\n"))
+    assert XDR3G(msg).format_ts(msg.ts) == "2020-09-21T06:37:59.790000Z"
+
+
+def test_parallel_parsing_by_chunks(tmp_path):
+    import decoded_corr
+
+    paths = []
+    for nb in range(3):
+        path = tmp_path / f"trace{nb}.txt"
+        path.write_text("\n".join(msg_4g_from_text + synthetic_4g(150, seed=nb)))
+        paths.append(path)
+    source = MappedFile.open(paths[0])
+    expected = list(source.spans(Message4G.re_msg_nm))
+    for size in (1, 500, 4000, len(source)):
+        chunks = source.chunks(Message4G.re_msg_nm, size)
+        assert chunks[0][0] == 0 and chunks[-1][1] == len(source)
+        spans = [
+            span
+            for start, end in chunks
+            for span in source.spans(Message4G.re_msg_nm, start, end)
+        ]
+        assert spans == expected
+
+    expected = [
+        (path, str(msg), msg.body)
+        for path in paths
+        for msg in decoded_corr.read_messages(path, Message4G, l3=True)
+        if msg.matches(gci=153800001)
+    ]
+    parsed = [
+        (path, str(msg), msg.body)
+        for path, msgs in decoded_corr.parse_files(
+            paths,
+            Message4G,
+            jobs=2,
+            chunk_size=3000,
+            l3=True,
+            filters={"gci": 153800001},
+        )
+        for msg in msgs
+    ]
+    assert 0 < len(parsed) < 3 * (150 + len(msg_4g_from_text))
+    assert parsed == expected
+    # workers send fields and spans, bodies stay in the parent's mapping
+    for _, msgs in decoded_corr.parse_files(paths[:1], Message4G, 2, 3000):
+        assert all(msg.text is None and msg.source is not None for msg in msgs)
+
+
+def test_message_index_sidecar(tmp_path):
+    path = tmp_path / "trace.txt"
+    path.write_text("\n".join(msg_4g_from_text + synthetic_4g(300, seed=7)) + "\n")
+    source = MappedFile.open(path)
+    expected = list(source.messages(Message4G, l3=True))
+
+    index = MessageIndex.open(path, Message4G, jobs=2, chunk_size=5000)
+    sidecar = MessageIndex.sidecar(path)
+    assert sidecar.exists() and len(index) == len(expected)
+    loaded = MessageIndex.load(sidecar, path, Message4G)
+    assert loaded is not None
+    msgs = list(loaded.messages(source, l3=True))
+    assert [str(m) for m in msgs] == [str(m) for m in expected]
+    assert [(m.span, m.body, m.l3, m.ts) for m in msgs] == [
+        (m.span, m.body, m.l3, m.ts) for m in expected
+    ]
+    assert [m.fp for m in msgs] == [m.fp for m in expected]
+
+    filters = {"gci": 153800000, "crnti": None}
+    assert [m.span for m in loaded.messages(source, filters=filters)] == [
+        m.span for m in expected if m.matches(**filters)
+    ]
+
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    MessageIndex.open(path, Message4G, cache_dir=str(cache_dir))
+    assert len(list(cache_dir.glob("trace.txt.*.idx"))) == 1
+
+    # the rows of several files as one set of columns
+    rows = MessageRows(Message4G)
+    rows.add(path, loaded, filters)
+    rows.add(path, loaded, clock=lambda ts: ts + 1)
+    wanted = [m for m in expected if m.matches(**filters)] + expected
+    assert len(rows) == len(wanted)
+    assert rows.columns.fps == b"".join(m.fp for m in wanted)
+    picked = rows.messages([len(wanted) - 1, 0], l3=True)
+    assert [(m.span, m.l3, m.ts) for m in picked] == [
+        (wanted[-1].span, wanted[-1].l3, wanted[-1].ts + 1),
+        (wanted[0].span, wanted[0].l3, wanted[0].ts),
+    ]
+
+    # a truncated sidecar is rebuilt
+    data = sidecar.read_bytes()
+    for size in (40, len(data) - 8):
+        sidecar.write_bytes(data[:size])
+        assert MessageIndex.load(sidecar, path, Message4G) is None
+    assert len(MessageIndex.open(path, Message4G)) == len(expected)
+    assert sidecar.read_bytes() == data
+
+    # a compressed file is not decompressed when its sidecar is up to date
+    gz_path = tmp_path / "trace.txt.gz"
+    with gzip.open(gz_path, "wt") as file_hnd:
+        file_hnd.write(path.read_text())
+    MessageIndex.open(gz_path, Message4G)
+    MappedFile._opened.pop(gz_path)
+    assert len(MessageIndex.open(gz_path, Message4G)) == len(expected)
+    assert gz_path not in MappedFile._opened
+
+    # a sidecar is not used once its file has changed
+    with open(path, "a") as file_hnd:
+        file_hnd.write(msg_4g_from_text[2] + "\n")
+    assert MessageIndex.load(sidecar, path, Message4G) is None
+
+
+def test_xdr_store_lookups(tmp_path):
+    correlator = Correlator(XDR4G)
+    for msg in parse_4g(msg_4g_from_text[1:] + synthetic_4g(200, seed=8)):
+        correlator.add(msg)
+    xdrs = correlator.flush()
+    xdrs[1].tmsi = 0xC0FFEE
+    path = str(tmp_path / "xdrs.sqlite")
+    with XDRStore(path, batch_size=7) as store:
+        store.start_run(["trace.txt"])
+        for nb, xdr in enumerate(xdrs):
+            store.add(xdr, nb % 3)
+    with XDRStore(path) as store:
+        assert [text for _, _, text in store.query(XDR4G, {"tmsi": 0xC0FFEE})] == [
+            str(xdrs[1])
+        ]
+        gci = xdrs[0].gci
+        ts_from, ts_to = xdrs[0].ts_begin, xdrs[0].ts_end
+        found = list(store.query(XDR4G, {"gci": gci}, ts_from, ts_to))
+        assert [text for _, _, text in found] == [
+            str(xdr)
+            for xdr in sorted(xdrs, key=lambda xdr: xdr.ts_begin)
+            if xdr.gci == gci and xdr.ts_end >= ts_from and xdr.ts_begin <= ts_to
+        ]
+        assert {pos for _, pos, _ in store.query(filters={"scenario": 2})} == {2}
+        assert not list(store.query(XDR3G))
+        with pytest.raises(ValueError):
+            list(store.query(filters={"name": 1}))
+
+
+def test_sessions_resume_from_checkpoint(tmp_path):
+    msgs = parse_4g(synthetic_4g(1500, seed=6))
+    expected = linear_correlate(msgs)
+    first = Correlator(XDR4G)
+    for msg in msgs[:700]:
+        first.add(msg)
+    finished = first.drain()
+    path = tmp_path / "open.ckpt"
+    Checkpoint(XDR4G, first.open_xdrs(), first.watermark, files=["a"]).save(path)
+    checkpoint = Checkpoint.load(path, XDR4G)
+    assert checkpoint.files == ["a"] and checkpoint.xdrs
+    second = Correlator(XDR4G)
+    second.resume(checkpoint.xdrs, checkpoint.watermark)
+    for msg in msgs[700:]:
+        second.add(msg)
+    finished += second.flush()
+    assert sorted(repr(xdr) for xdr in finished) == sorted(
+        repr(xdr) for xdr in expected
+    )
+    assert Checkpoint.load(tmp_path / "none", XDR3G).xdrs == []
+    with pytest.raises(ValueError):
+        Checkpoint.load(path, XDR3G)
+
+
+def test_files_in_time_order(tmp_path):
+    import decoded_corr
+
+    def trace(name, hms, nb=3):
+        texts = synthetic_4g(nb, seed=1)
+        texts[0] = re.sub(r"@ [\d:.]+ {", f"@ {hms} {{", texts[0])
+        path = tmp_path / name
+        path.write_text("\n".join(texts) + "\n")
+        return path
+
+    evening = trace("a.txt", "23:45:00.000")
+    night = trace("b.txt", "00:00:00.500")
+    late = trace("c.txt", "23:30:00.000")
+    empty = tmp_path / "d.txt"
+    empty.write_text("")
+    order = decoded_corr.time_order([empty, night, evening, late], Message4G)
+    assert order == [late, evening, night, empty]
+    morning = trace("e.txt", "06:00:00.000")
+    assert decoded_corr.time_order([night, morning], Message4G) == [night, morning]
+
+
+def test_checkpoint_series_finalized(tmp_path, monkeypatch, capsys):
+    import decoded_corr
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(decoded_corr, "JOBS_NB", 3)
+    texts = synthetic_4g(900, seed=3)
+    paths = []
+    for nb in range(3):
+        paths.append(tmp_path / f"part{nb}.txt")
+        paths[-1].write_text("\n".join(texts[nb * 300 : (nb + 1) * 300]) + "\n")
+
+    def run(*args):
+        # XDRs of a run are kept in a module list
+        monkeypatch.setattr(decoded_corr, "XDRs", [])
+        decoded_corr.main(["--parse-jobs", "1"] + [str(arg) for arg in args])
+        return sorted(
+            line.split(" ", 2)[2]
+            for line in capsys.readouterr().out.splitlines()
+            if re.match(r"\d+ \d+ \d", line)
+        )
+
+    expected = run("--correlate", "--file", *paths)
+    checkpoint = tmp_path / "open.ckpt"
+    # given out of order, taken in time order
+    series = run("--checkpoint", checkpoint, "--file", paths[1], paths[0])
+    assert checkpoint.exists()
+    series += run("--checkpoint", checkpoint, "--file", paths[2])
+    series += run("--checkpoint", checkpoint, "--finalize")
+    assert not checkpoint.exists()
+    assert sorted(series) == expected
+
+    # from the columns of the parse cache, as built then as found
+    for _ in range(2):
+        cached = run("--parse-cache", "--checkpoint", checkpoint, "--file", *paths)
+        cached += run("--checkpoint", checkpoint, "--finalize")
+        assert sorted(cached) == expected
+
+
+def test_sharding_keeps_xdrs_whole():
+    msgs = parse_4g(synthetic_4g(1500, seed=7))
+    sharder = Sharder(XDR4G, 2)
+    shards = [[], []]
+    for msg in msgs:
+        shards[sharder(msg)].append(msg)
+    assert sharder.loads == [len(shard) for shard in shards]
+    assert all(shards)
+    for shard in shards:
+        assert len({msg.gci for msg in shard}) == 1
+    xdrs = [xdr for shard in shards for xdr in linear_correlate(shard)]
+    assert sorted(repr(xdr) for xdr in xdrs) == sorted(
+        repr(xdr) for xdr in linear_correlate(msgs)
+    )
+    for xdr in xdrs:
+        assert sharder(xdr) == sharder(xdr.messages[0])
+
+
+@pytest.mark.parametrize("shards", [4, 8])
+def test_split_shards_are_balanced(tmp_path, shards):
+    path = tmp_path / "trace.txt"
+    # one busy cell
+    with open(path, "w") as file_hnd:
+        write_trace(file_hnd, 500000, "4G", Profile(cells=1, seed=3))
+    msgs = list(MappedFile.open(path).messages(Message4G))
+    assert len({msg.gci for msg in msgs}) == 1
+    correlator = Correlator(XDR4G)
+    for msg in msgs[:1000]:
+        correlator.add(msg)
+    resumed = correlator.flush()
+    groups = [xdr.messages for xdr in resumed] + [[msg] for msg in msgs[1000:]]
+    sharder = Sharder(XDR4G, shards)
+    routes = sharder.split(groups)
+    assert sharder.loads == [
+        sum(len(group) for group, shard in zip(groups, routes) if shard == nb)
+        for nb in range(shards)
+    ]
+    assert max(sharder.loads) / (len(msgs) / shards) < 1.1
+
+    # every XDR stays whole, resumed ones included
+    shard_of = {
+        id(msg): shard for group, shard in zip(groups, routes) for msg in group
+    }
+    correlator = Correlator(XDR4G)
+    correlator.resume(resumed)
+    for msg in msgs[1000:]:
+        correlator.add(msg)
+    for xdr in correlator.flush():
+        assert len({shard_of[id(msg)] for msg in xdr.messages}) == 1
+
+
+def test_columnar_messages_rebuild_xdrs():
+    msgs = parse_4g(synthetic_4g(1000, seed=8) + msg_4g_from_text[1:3] * 2)
+    columns = pickle.loads(pickle.dumps(MessageColumns(Message4G, msgs)))
+    bare = columns.messages()
+    assert len(columns) == len(msgs)
+    for msg, row in zip(msgs, bare):
+        assert row.body is None and row.l3 is None
+        assert (row.name, row.ts, row.fp) == (msg.name, msg.ts, msg.fp)
+        for key in Message4G.key_fields:
+            assert getattr(row, key) == getattr(msg, key)
+    rows = {id(msg): nb for nb, msg in enumerate(bare)}
+    xdrs = [
+        build_xdr(XDR4G, msgs, [rows[id(msg)] for msg in xdr.messages])
+        for xdr in linear_correlate(bare)
+    ]
+    assert [str(xdr) for xdr in xdrs] == [str(xdr) for xdr in linear_correlate(msgs)]
+
+
+def random_messages(msg_class, nb, seed):
+    """Bare messages with few key values, reordered and repeated bodies."""
+    rnd = random.Random(seed)
+    result = []
+    ts = 0
+    for _ in range(nb):
+        ts += rnd.choice((0, 10, 500, 5000, 30000, 61000, 130000, 301000))
+        msg = msg_class()
+        msg.name = rnd.choice(("RRC_A", "S1_B", XDR4G.x2_hnd_req))
+        msg.ts = ts - rnd.choice((0, 0, 0, 1000, 70000, 200000, 400000))
+        if msg_class is Message4G:
+            msg.gci = rnd.choice((1, 2))
+            msg.enbid = rnd.choice((None, 10, 11))
+            msg.trsr = rnd.choice((None, 5, 6)) if msg.enbid else None
+            msg.crnti = rnd.choice((None, 100, 101))
+        else:
+            msg.rncmodid = rnd.choice((0, 1))
+            msg.ueid = rnd.choice((None, 1, 2, 3))
+        msg.fp = bytes([rnd.randrange(60)]) * 16
+        result.append(msg)
+    return result
+
+
+def test_numpy_engine_matches_correlator():
+    pytest.importorskip("numpy")
+    import decoded_corr
+
+    cases = [(XDR4G, parse_4g(msg_4g_from_text))]
+    cases += [(XDR4G, parse_4g(synthetic_4g(2000, seed=seed))) for seed in (9, 10)]
+    msgs_3g = []
+    for text in msg_3g_from_text:
+        msg = Message3G()
+        msg.from_text(text.split("\n"))
+        msgs_3g.append(msg)
+    cases.append((XDR3G, msgs_3g))
+    for seed in range(40):
+        xdr_class = (XDR4G, XDR3G)[seed % 2]
+        msg_class = (Message4G, Message3G)[seed % 2]
+        cases.append((xdr_class, random_messages(msg_class, 150, seed)))
+    for nb, (xdr_class, msgs) in enumerate(cases):
+        try:
+            # XDRs left open after the first messages, resumed by the rest
+            _, still_open, _ = decoded_corr.correlate(
+                xdr_class, MessageColumns(type(msgs[0]), msgs[:50]), keep_open=True
+            )
+        except AssertionError:
+            # conflicting strict fields in random messages
+            continue
+        resumed = [msgs[row] for rows in still_open for row in rows]
+        open_rows = []
+        for rows in still_open:
+            start = sum(len(prev) for prev in open_rows)
+            open_rows.append(list(range(start, start + len(rows))))
+        columns = MessageColumns(type(msgs[0]), resumed + msgs[50:])
+        for watermark in (None, msgs[-1].ts + 200000):
+            args = (xdr_class, columns, open_rows, watermark, True)
+            try:
+                expected = decoded_corr.correlate(*args)[:2]
+            except AssertionError:
+                continue
+            assert decoded_corr.correlate(*args, engine="numpy")[:2] == expected, nb
+
+
+def test_numpy_engine_fast_path_share(tmp_path, monkeypatch):
+    pytest.importorskip("numpy")
+    import decoded_corr
+    from correlator import vector
+
+    slow_rows = []
+    correlate_segments = vector._correlate_segments
+
+    def counted(xdr_class, columns, segments, *args):
+        slow_rows.extend(row for rows in segments for row in rows)
+        return correlate_segments(xdr_class, columns, segments, *args)
+
+    monkeypatch.setattr(vector, "_correlate_segments", counted)
+    # late messages and X2 handovers are left to the Correlator, rows
+    # linked by crnti only are not
+    for profile, share in (
+        (Profile(seed=4), 0.25),
+        (Profile(seed=4, late_rate=0, x2_rate=0), 0),
+    ):
+        path = tmp_path / "trace.txt"
+        with open(path, "w") as file_hnd:
+            write_trace(file_hnd, 500000, "4G", profile)
+        columns = MessageColumns(
+            Message4G, list(decoded_corr.read_messages(path, Message4G))
+        )
+        del slow_rows[:]
+        xdrs = decoded_corr.correlate(XDR4G, columns, engine="numpy")[:2]
+        assert len(slow_rows) <= share * len(columns)
+        assert xdrs == decoded_corr.correlate(XDR4G, columns)[:2]
+
+
+def test_repeated_messages_are_skipped_by_fingerprint():
+    first, second = parse_4g(msg_4g_from_text[1:3])
+    again = parse_4g(msg_4g_from_text[1:2])[0]
+    assert again == first and hash(again) == hash(first) and again != second
+    assert len({first, second, again}) == 2
+    assert len(first.fp) == FP_SIZE
+    xdr = XDR4G(first)
+    xdr.add_msg(again)
+    xdr.add_msg(second)
+    assert xdr.messages == [first, second]
+    other = XDR4G(parse_4g(msg_4g_from_text[2:3])[0])
+    other.merge(xdr)
+    assert len(other.messages) == 2 and other.fps == {first.fp, second.fp}
+
+
+def test_meta_extraction_single_pass():
+    msg = parse_4g(msg_4g_from_text[1:2])[0]
+    msg.name = "RRC_RRC_CONNECTION_SETUP_COMPLETE"
+    xdr = XDR4G(msg)
+    pdml = (
+        '<field name="gsm_a.imsi" value="999"/>\n'
+        '<field name="nas_eps.emm.m_tmsi" show="x" value="c2a1"/>\n'
+        '<field name="gsm_a.tmsi" value="ffff"/>\n'
+    )
+    xdr.extract_meta("S1_UE_CONTEXT_RELEASE_COMMAND", pdml)
+    assert xdr.tmsi is None
+    xdr.extract_meta(msg.name, pdml)
+    assert xdr.tmsi == 0xC2A1
+
+    import decoded_corr
+
+    msgs = parse_4g(msg_4g_from_text[1:3])
+    msgs[1].name = "S1_INITIAL_CONTEXT_SETUP_REQUEST"
+    xdr = XDR4G(msgs[0])
+    xdr.add_msg(msgs[1])
+    stats = Counter()
+    with L3Decoder({}, command=STUB_DECODER) as decoder:
+        decoded_corr.decode_xdrs(decoder, [xdr], stats)
+    assert xdr.tmsi == int(msgs[1].l3[-8:], 16)
+    assert stats["l3_msgs"] == 2
+
+
+@pytest.mark.parametrize("tech", ["4G", "3G"])
+def test_synthetic_trace(tmp_path, tech):
+    path = tmp_path / "trace.txt"
+    with open(path, "w") as file_hnd:
+        nb = write_trace(file_hnd, 200000, tech, Profile(cells=5, ues=20, seed=1))
+    assert 200000 <= path.stat().st_size < 201000
+    Message_, XDR_ = (Message4G, XDR4G) if tech == "4G" else (Message3G, XDR3G)
+    msgs = list(MappedFile.open(path).messages(Message_, l3=True))
+    assert len(msgs) == nb
+    assert all(msg.l3 for msg in msgs)
+    handover = "X2_HANDOVER_REQUEST" if tech == "4G" else "RANAP_RELOCATION_REQUEST"
+    assert any(msg.name == handover for msg in msgs)
+    if tech == "4G":
+        # NULL_ENB is parsed as no eNB id
+        assert any(msg.enbid is None and msg.trsr is None for msg in msgs)
+    correlator = Correlator(XDR_)
+    for msg in msgs:
+        correlator.add(msg)
+    xdrs = correlator.flush()
+    assert len(xdrs) < nb / 5
+
+
+@pytest.mark.parametrize("tech", ["4G", "3G"])
+def test_synthetic_xdrs_hold_one_session(tmp_path, tech):
+    path = tmp_path / "trace.txt"
+    # few UEs, so that 3G UE context ids come back
+    with open(path, "w") as file_hnd:
+        write_trace(file_hnd, 400000, tech, Profile(cells=2, ues=4, session_s=20))
+    Message_, XDR_ = (Message4G, XDR4G) if tech == "4G" else (Message3G, XDR3G)
+    msgs = list(MappedFile.open(path).messages(Message_, l3=True))
+    # the m-TMSI of each session
+    sessions = {msg.l3[-8:] for msg in msgs}
+    if tech == "3G":
+        assert len({msg.ueid for msg in msgs}) < len(sessions)
+    correlator = Correlator(XDR_)
+    for msg in msgs:
+        correlator.add(msg)
+    for xdr in correlator.flush():
+        assert len({msg.l3[-8:] for msg in xdr.messages}) == 1
+
+
+def test_profiler_stages():
+    profiler = Profiler()
+    double = profiler.wrap("double", lambda val: val * 2)
+    with profiler.stage("run") as stage:
+        values = [double(val) for val in profiler.iterate("read", range(5), 2)]
+        stage.items = len(values)
+    assert values == [0, 2, 4, 6, 8]
+    # one step per batch of items
+    assert list(profiler.iterate("write", range(4), 2)) == [0, 1, 2, 3]
+    report = profiler.report()
+    stages = {item["stage"]: item for item in report["stages"]}
+    assert set(stages) == {"run", "run;read", "run;double", "write"}
+    assert stages["run"]["items"] == 5
+    assert stages["run;read"]["items"] == 5
+    assert stages["run;read"]["calls"] == 3
+    assert stages["write"]["calls"] == 3
+    assert stages["run;double"]["calls"] == 5
+    nested = stages["run;read"]["wall_s"] + stages["run;double"]["wall_s"]
+    assert stages["run"]["self_wall_s"] == pytest.approx(
+        stages["run"]["wall_s"] - nested, abs=1e-5
+    )
+    assert [line.split()[0] for line in report["folded"]] == sorted(stages)
+
+    # nothing is wrapped when profiling is off
+    items = iter(range(3))
+    assert NULL_PROFILER.iterate("read", items) is items
+    assert NULL_PROFILER.wrap("double", len) is len
+    with NULL_PROFILER.stage("run") as stage:
+        stage.items = 3
@@ -0,0 +1,241 @@
+from typing import List, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # optional, only needed by the numpy engine
+    np = None
+
+from .classes import XDR4G
+from .columns import NONE, MessageColumns, build_xdr
+from .engine import Correlator, connected
+
+__all__ = ["correlate_columns"]
+
+
+def _column(columns: MessageColumns, key: str):
+    return np.frombuffer(columns.fields[key], dtype=np.int64)
+
+
+def _components(xdr_class, columns: MessageColumns):
+    """Component number of each row; rows of two components never share an XDR.
+
+    Matching needs equal ``key_filter`` values and, when the class declares
+    ``index_fields``, one equal index field, so rows are joined on each index
+    value they carry. Rows with none of them stay alone.
+    """
+    fields = xdr_class.key_filter + xdr_class.index_fields
+    keys = np.stack([_column(columns, key) for key in fields], axis=1)
+    tuples, inverse = np.unique(keys, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if not xdr_class.index_fields:
+        return inverse
+    key_nb = len(xdr_class.key_filter)
+    labels = []
+    for values in tuples.tolist():
+        key = tuple(values[:key_nb])
+        labels.append(
+            [
+                (key, field, val)
+                for field, val in enumerate(values[key_nb:])
+                if val != NONE
+            ]
+        )
+    component = np.array(connected(labels), dtype=np.int64)
+    return component[inverse]
+
+
+def correlate_columns(
+    xdr_class,
+    columns: MessageColumns,
+    open_rows=(),
+    watermark: int = None,
+    reorder_window: float = 60,
+) -> List[Tuple[List[int], bool]]:
+    """The XDRs a ``Correlator`` builds from the rows of ``columns`` in order.
+
+    Returns the rows of each XDR in creation order and whether it is still
+    open once the stream time reaches ``watermark``, i.e. ends less than
+    ``T1`` plus ``reorder_window`` seconds before it; no XDR expires while
+    rows are added. As in ``correlate()``, the first rows hold the XDRs of
+    ``open_rows`` resumed from a checkpoint.
+
+    Rows are cut into segments: a component, see ``_components()``, split
+    where sorted timestamps are ``I1`` or more apart, a gap no XDR bridges.
+    A segment arriving in time order without duplicate bodies, and for 4G
+    on one enbid/trsr and one crnti without X2 handover request, has its
+    XDRs computed over arrays: rows join the last row they match unless
+    over ``T1`` later, and a 4G row with both an enbid and a crnti merges
+    the XDRs of each. Other segments go through a ``Correlator`` of their
+    own.
+    """
+    size = len(columns)
+    if not size:
+        return []
+    ts = np.frombuffer(columns.ts, dtype=np.int64)
+    resumed_nb = sum(len(xdr_rows) for xdr_rows in open_rows)
+    if resumed_nb < size:
+        last_ts = int(ts[resumed_nb:].max())
+        watermark = last_ts if watermark is None else max(watermark, last_ts)
+    window = (xdr_class.T1 + reorder_window) * 1000
+
+    component = _components(xdr_class, columns)
+    by_time = np.lexsort((ts, component))
+    gap = np.diff(ts[by_time])
+    # a gap over T1 is not bridged either when no row after it arrives
+    # before a row ahead of it
+    # ranked by component first, so that components do not mix
+    arrival = component[by_time] * size + by_time
+    arrived_before = np.maximum.accumulate(arrival)
+    arriving_after = np.minimum.accumulate(arrival[::-1])[::-1]
+    cut = np.ones(size, dtype=bool)
+    cut[1:] = (
+        (np.diff(component[by_time]) != 0)
+        | (gap >= xdr_class.I1 * 1000)
+        | ((gap > xdr_class.T1 * 1000) & (arrived_before[:-1] < arriving_after[1:]))
+    )
+    segment = np.empty(size, dtype=np.int64)
+    segment[by_time] = np.cumsum(cut) - 1
+
+    # rows of each segment in arrival order
+    order = np.argsort(segment, kind="stable")
+    seg_of = segment[order]
+    ts_of = ts[order]
+    seg_start = np.ones(size, dtype=bool)
+    seg_start[1:] = seg_of[1:] != seg_of[:-1]
+    inner = ~seg_start
+    slow = np.zeros(seg_of[-1] + 1, dtype=bool)
+    slow[segment[:resumed_nb]] = True
+    backwards = np.zeros(size, dtype=bool)
+    backwards[1:] = ts_of[1:] < ts_of[:-1]
+    slow[seg_of[backwards & inner]] = True
+    fps = np.frombuffer(columns.fps, dtype=np.uint64).reshape(size, -1)
+    _, fp_inverse, fp_counts = np.unique(
+        fps, axis=0, return_inverse=True, return_counts=True
+    )
+    slow[segment[fp_counts[fp_inverse.reshape(-1)] > 1]] = True
+    if issubclass(xdr_class, XDR4G):
+        # rows with an enbid share it and their trsr, rows with a crnti
+        # share it too
+        enbid = _column(columns, "enbid")
+        trsr = _column(columns, "trsr")
+        crnti = _column(columns, "crnti")
+        for keys in ((enbid, trsr), (crnti,)):
+            keyed = order[keys[0][order] != NONE]
+            keyed_seg = segment[keyed]
+            changed = np.zeros(len(keyed), dtype=bool)
+            for key in keys:
+                changed[1:] |= np.diff(key[keyed]) != 0
+            changed[1:] &= keyed_seg[1:] == keyed_seg[:-1]
+            slow[keyed_seg[changed]] = True
+        if xdr_class.x2_hnd_req in columns.names:
+            x2_id = columns.names.index(xdr_class.x2_hnd_req)
+            name_ids = np.frombuffer(columns.name_ids, dtype=np.uint16)[order]
+            slow[seg_of[name_ids == x2_id]] = True
+
+    # fast segments: a row joins the XDR of an earlier row ``prev`` unless it
+    # comes over T1 later
+    def joins(prev, row):
+        return ts_of[row] - ts_of[prev] <= xdr_class.T1 * 1000
+
+    position = np.arange(size)
+    # no XDR is left to join after a break
+    breaks = seg_start.copy()
+    breaks[1:] |= ~joins(position[:-1], position[1:])
+    last_break = np.maximum.accumulate(np.where(breaks, position, 0))
+    parent = np.where(breaks, position, position - 1)
+    # rows of the one XDR taking every row until the next break
+    linked = np.ones(size, dtype=bool)
+    # (row, row) of the XDRs merged by a row, as positions
+    pairs = np.empty((2, 0), dtype=np.int64)
+    if issubclass(xdr_class, XDR4G):
+        # rows with an enbid only and rows with a crnti only make XDRs of
+        # their own, joining the last row sharing their key; the first row
+        # with both merges the two, its XDR then takes every row
+        with_enb = enbid[order] != NONE
+        with_crnti = crnti[order] != NONE
+        both = with_enb & with_crnti
+        last_both = np.maximum.accumulate(np.where(both, position, -1))
+        linked = last_both >= last_break
+        first_both = both.copy()
+        first_both[1:] &= last_both[:-1] < last_break[1:]
+        prevs = []
+        for keyed in (with_enb, with_crnti):
+            # last earlier row with the key, -1 for none
+            prev = np.full(size, -1)
+            prev[1:] = np.maximum.accumulate(np.where(keyed, position, -1))[:-1]
+            joined = (prev >= last_break) & joins(prev, position)
+            prevs.append(np.where(joined, prev, position))
+        enb_prev, crnti_prev = prevs
+        parent = np.where(linked, parent, np.where(with_enb, enb_prev, crnti_prev))
+        parent[first_both] = np.minimum(enb_prev, crnti_prev)[first_both]
+        merging = first_both & (enb_prev != position) & (crnti_prev != position)
+        pairs = np.stack([enb_prev[merging], crnti_prev[merging]])
+    root = parent
+    while True:
+        next_root = root[root]
+        if (next_root == root).all():
+            break
+        root = next_root
+    # the XDR created first takes the rows of the one merged into it
+    ends = root[pairs]
+    target = position.copy()
+    target[ends.max(axis=0)] = ends.min(axis=0)
+    xdr_of = target[root]
+
+    # rows of each XDR in the order the Correlator adds them: of the XDR
+    # created first, of the one merged into it, then from the merging row on
+    fast = np.flatnonzero(~slow[seg_of])
+    fast = fast[np.lexsort((fast, root[fast], linked[fast], xdr_of[fast]))]
+    result = []
+    xdr_starts = np.flatnonzero(np.diff(xdr_of[fast]) != 0) + 1
+    for rows in np.split(order[fast], xdr_starts):
+        if not len(rows):
+            continue
+        last = rows[-1]
+        expired = watermark is not None and ts[last] < watermark - window
+        result.append((rows.tolist(), not expired))
+
+    slow_starts = np.flatnonzero(seg_start & slow[seg_of])
+    if len(slow_starts):
+        seg_ends = np.append(np.flatnonzero(seg_start)[1:], size)
+        ends = seg_ends[np.searchsorted(np.flatnonzero(seg_start), slow_starts)]
+        result.extend(
+            _correlate_segments(
+                xdr_class,
+                columns,
+                [order[start:end].tolist() for start, end in zip(slow_starts, ends)],
+                open_rows,
+                watermark,
+                reorder_window,
+            )
+        )
+    result.sort(key=lambda item: item[0][0])
+    return result
+
+
+def _correlate_segments(
+    xdr_class, columns, segments, open_rows, watermark, reorder_window
+):
+    rows = sorted(row for seg_rows in segments for row in seg_rows)
+    msgs = dict(zip(rows, columns.messages(rows)))
+    row_of = {id(msg): row for row, msg in msgs.items()}
+    resumed_nb = sum(len(xdr_rows) for xdr_rows in open_rows)
+    open_by_row = {xdr_rows[0]: xdr_rows for xdr_rows in open_rows}
+    for seg_rows in segments:
+        correlator = Correlator(xdr_class)
+        correlator.resume(
+            [
+                build_xdr(xdr_class, msgs, open_by_row[row])
+                for row in seg_rows
+                if row in open_by_row
+            ]
+        )
+        for row in seg_rows:
+            if row < resumed_nb:
+                continue
+            correlator.add(msgs[row])
+        if watermark is not None:
+            correlator.expire(watermark, reorder_window)
+        open_ids = {id(xdr) for xdr in correlator.open_xdrs()}
+        for xdr in correlator.xdrs:
+            yield [row_of[id(msg)] for msg in xdr.messages], id(xdr) in open_ids
@@ -1,27 +1,36 @@
 import argparse
 import concurrent.futures
 import csv
+import functools
 import gzip
+import itertools
 import multiprocessing as mp
+import os
 import pathlib
-import pipes
+import queue
+import shlex
 import sys
-import tempfile
-from collections import defaultdict
+import time
+import traceback
+from collections import Counter, defaultdict, deque
 from datetime import datetime
 from typing import List
 
-from correlator.classes import (XDR, XDR3G, XDR4G, Message, Message3G,
-                                Message4G, XDR_scenario)
+from correlator.classes import (DAY_MS, XDR, XDR3G, XDR4G, DayClock,
+                                Message3G, Message4G, XDR_scenario)
+from correlator.columns import MessageColumns, build_xdr
+from correlator.engine import Checkpoint, Correlator, Sharder
+from correlator.index import MessageIndex, MessageRows, index_chunk
+from correlator.l3 import L3Cache, L3Decoder
+from correlator.metrics import NULL_PROFILER, Profiler
+from correlator.source import MappedFile
+from correlator.store import XDRStore
+from correlator.vector import correlate_columns, np
 
 DLT_FILE = "dlt.csv"
 DLTs = {}
-L3_LOOK_FOR = ("tmsi", "imsi", "imei", "teid")
 XDRs: List[XDR] = []
 
-# smm = Manager()
-# TSHARK_CACHE = smm.dict()
-
 
 def get_vcpu_nb():
     # hope not on restricted cpu usage)
@@ -30,72 +39,409 @@ def get_vcpu_nb():
 
 
 CPU_NB = get_vcpu_nb()
-JOBS_NB = int(2 / 3 * CPU_NB)
+JOBS_NB = max(1, int(2 / 3 * CPU_NB))
+# streaming mode: messages per batch sent to a worker, batches queued per worker
+STREAM_BATCH = 1000
+STREAM_QUEUE_SIZE = 16
+# seconds past T1 a message may arrive behind the stream time and still join
+# its XDR when streaming, and that sessions are kept open in a checkpoint
+REORDER_WINDOW = 60
+# seconds between checks that the streaming workers are still running
+WORKER_POLL = 1
+# parallel parsing: bytes per chunk of input, chunks parsed ahead per process
+PARSE_CHUNK = 16 * 2 ** 20
+PARSE_AHEAD = 2
+# lazy L3 decoding: XDRs decoded together right before they are printed
+OUTPUT_BATCH = 10000
 
 
-def decode_l3_short(msg: Message):
-    return decode_l3(msg)
+def l3_decoder(parsed, cache: L3Cache = None):
+    """Factory for the L3 decoder requested on the command line, if any."""
+    if not parsed.l3:
+        return None
+    kwargs = {"fulldecode": parsed.fulldecode, "cache": cache}
+    if parsed.decoder:
+        kwargs["command"] = shlex.split(parsed.decoder)
+    return functools.partial(L3Decoder, DLTs, **kwargs)
 
 
-def decode_l3_full(msg: Message):
-    return decode_l3(msg, True)
+def decode_xdrs(decoder: L3Decoder, xdrs: List[XDR], counters: Counter, names=None):
+    """Decodes the messages of all XDRs as one batch, each message once.
 
+    With ``names``, only the messages so called are decoded, e.g. those
+    ``extract_rules`` read. The metas of an XDR are added in message order
+    once all its messages are decoded."""
+    ts_start = time.perf_counter()
+    msgs = [
+        msg
+        for xdr in xdrs
+        for msg in xdr.messages
+        if msg.has_l3
+        and msg.meta is None
+        and (names is None or msg.name in names)
+    ]
+    for msg, meta in zip(msgs, decoder.decode(msgs)):
+        msg.meta = meta
+    decoded = {id(msg) for msg in msgs}
+    for xdr in xdrs:
+        new_msgs = [msg for msg in xdr.messages if id(msg) in decoded]
+        for msg in new_msgs:
+            xdr.extract_meta(msg.name, msg.meta)
+        if new_msgs and all(
+            msg.meta is not None or not msg.has_l3 for msg in xdr.messages
+        ):
+            for msg in xdr.messages:
+                if msg.meta is not None:
+                    xdr.add_meta(f"{msg.name}: {msg.meta}")
+    counters["l3_msgs"] += len(msgs)
+    counters["l3_time"] += time.perf_counter() - ts_start
 
-def decode_l3(msg: Message, fulldecode: bool = False):
-    if msg.l3 is None:
-        return
-    p = t = None
-    if False and msg.name in TSHARK_CACHE:
-        p = TSHARK_CACHE[msg.name]
+
+def correlate(
+    XDR_,
+    columns: MessageColumns,
+    open_rows=(),
+    watermark=None,
+    keep_open=False,
+    engine="python",
+    reorder_window=REORDER_WINDOW,
+):
+    """XDRs of one shard, as row lists of its ``columns``, in creation order.
+
+    The first rows hold the XDRs left open by a previous run, listed in
+    ``open_rows``. No XDR expires while correlating, so that late messages
+    still reach theirs. With ``keep_open`` those ending less than ``T1``
+    plus ``reorder_window`` seconds before ``watermark`` are returned apart
+    instead, for a checkpoint. The shard's message count and time come
+    last. The ``numpy`` engine gives the same XDRs."""
+    ts_start = time.perf_counter()
+    cpu_start = time.process_time()
+    resumed_nb = sum(len(xdr_rows) for xdr_rows in open_rows)
+    if engine == "numpy":
+        result = correlate_columns(
+            XDR_, columns, open_rows, watermark, reorder_window
+        )
     else:
-        p = pipes.Template()
-        p.append("xxd -r -p", "--")
-        p.append("od -Ax -tx1", "--")
-        p.append("text2pcap -a -l 147 -n - - 2>/dev/null", "--")
-        dlt = DLTs.get(msg.name, "s1ap") if "X2" not in msg.name else "x2ap"
-        tshark_cmd = (
-            'tshark -n -o \'uat:user_dlts:"User 0 (DLT=147)","'
-            + dlt
-            + '","0","","0",""\' -V -T pdml -r - 2>&1'
+        msgs = columns.messages()
+        rows = {id(msg): row for row, msg in enumerate(msgs)}
+        correlator = Correlator(XDR_)
+        correlator.resume(
+            [build_xdr(XDR_, msgs, xdr_rows) for xdr_rows in open_rows]
         )
-        p.append(tshark_cmd, "--")
-        if not fulldecode:
-            grep_cmd = 'grep -iP "' + "|".join(L3_LOOK_FOR) + '"'
-            p.append(grep_cmd, "--")
-
-        # TSHARK_CACHE[msg.name] = p
-    t = tempfile.NamedTemporaryFile(mode="w")
-    t.write(msg.l3)
-    t.flush()
-
-    f = p.open(t.name, "r")
-    result = f.read()
-    t.close()
-    return result
-
-
-def correlate(msgs: List[Message]):
-    matches = []
-    xdrs: List[XDR] = []
-    if len(msgs) > 0:
-        XDR_ = XDR4G if isinstance(msgs[0], Message4G) else XDR3G
-    print("Nb of msgs:", len(msgs), file=sys.stderr)
-    for msg in msgs:
-        for idx, xdr in enumerate(xdrs):
-            if not xdr.is_closed(msg.timestamp) and xdr.matches(msg):
-                matches.append(idx)
-        if len(matches) > 0:
-            if len(matches) > 1:
-                # print("merge required", file=sys.stderr)
-                for idx in matches[1:]:
-                    xdrs[matches[0]].merge(xdrs[idx])
-                for idx in matches[-1:0:-1]:
-                    del xdrs[idx]
-            xdrs[matches[0]].add_msg(msg)
-        else:
-            xdrs.append(XDR_(msg))
-        del matches[:]
-    return xdrs
+        for msg in msgs[resumed_nb:]:
+            correlator.add(msg)
+        if watermark is None:
+            watermark = correlator.watermark
+        if watermark is not None:
+            correlator.expire(watermark, reorder_window)
+        open_ids = {id(xdr) for xdr in correlator.open_xdrs()}
+        result = [
+            ([rows[id(msg)] for msg in xdr.messages], id(xdr) in open_ids)
+            for xdr in correlator.xdrs
+        ]
+    xdrs = [xdr_rows for xdr_rows, is_open in result if not (keep_open and is_open)]
+    still_open = [xdr_rows for xdr_rows, is_open in result if keep_open and is_open]
+    shard = {
+        "msgs": len(columns) - resumed_nb,
+        "time": time.perf_counter() - ts_start,
+        "cpu": time.process_time() - cpu_start,
+    }
+    return xdrs, still_open, shard
+
+
+def report_shards(shards: List[dict]):
+    for nb, shard in enumerate(shards):
+        print(
+            f"shard {nb}: {shard['msgs']} msgs, {shard['time']:.2f}s",
+            file=sys.stderr,
+        )
+    mean = sum(shard["msgs"] for shard in shards) / len(shards)
+    if mean:
+        skew = max(shard["msgs"] for shard in shards) / mean
+        print(f"shards: max/mean msgs {skew:.2f}", file=sys.stderr)
+
+
+class WorkerError(Exception):
+    """Traceback of an exception raised in a correlation worker."""
+
+
+def correlation_worker(
+    XDR_,
+    inbox,
+    outbox,
+    l3_decoder=None,
+    open_xdrs=(),
+    keep_open=False,
+    nb=0,
+    reorder_window=REORDER_WINDOW,
+):
+    try:
+        _correlation_worker(
+            XDR_, inbox, outbox, l3_decoder, open_xdrs, keep_open, nb, reorder_window
+        )
+    except Exception as exc:
+        # raised again in the parent, see correlate_stream()
+        outbox.put({"error": exc, "traceback": traceback.format_exc()})
+
+
+def _correlation_worker(
+    XDR_, inbox, outbox, l3_decoder, open_xdrs, keep_open, nb, reorder_window
+):
+    correlator = Correlator(XDR_, reorder_window)
+    correlator.resume(open_xdrs)
+    decoder = l3_decoder() if l3_decoder is not None else None
+    stats = Counter()
+    shard = {"nb": nb, "msgs": 0, "time": 0.0, "cpu": 0.0}
+
+    def send(xdrs):
+        if decoder is not None and xdrs:
+            decode_xdrs(decoder, xdrs, stats)
+        if xdrs:
+            outbox.put(xdrs)
+
+    while True:
+        batch = inbox.get()
+        if not isinstance(batch, list):
+            # end of input, with the stream time of all shards
+            break
+        ts_start = time.perf_counter()
+        cpu_start = time.process_time()
+        for msg in batch:
+            correlator.add(msg)
+        shard["msgs"] += len(batch)
+        shard["time"] += time.perf_counter() - ts_start
+        shard["cpu"] += time.process_time() - cpu_start
+        send(correlator.drain())
+    if batch is not None:
+        correlator.advance(batch)
+    send(correlator.drain() if keep_open else correlator.flush())
+    if decoder is not None:
+        decoder.close()
+        if decoder.cache is not None:
+            stats.update(decoder.cache.stats())
+    # end of this worker's output
+    outbox.put(
+        {
+            "stats": dict(stats),
+            "open": correlator.open_xdrs() if keep_open else [],
+            "shard": shard,
+        }
+    )
+
+
+def correlate_stream(
+    msgs,
+    XDR_,
+    emit,
+    l3_decoder=None,
+    checkpoint=None,
+    profiler=NULL_PROFILER,
+    finalize=False,
+    reorder_window=REORDER_WINDOW,
+):
+    """Feeds messages to long-lived correlation workers through bounded queues
+    and calls emit() on every XDR as soon as a worker closes it. Returns the
+    number of messages and the counters reported by the workers.
+
+    Workers close an XDR once the stream time is ``T1`` plus
+    ``reorder_window`` seconds past its end, see ``Correlator``: unlike in
+    batch runs, a message arriving later than that starts a new XDR.
+
+    With a ``checkpoint``, its XDRs are resumed and those still open at the
+    end are put back in it instead of being emitted, unless ``finalize``.
+    An exception raised by a worker is raised again here, and a worker that
+    dies without one raises ``WorkerError``; the other workers are stopped."""
+    keep_open = checkpoint is not None and not finalize
+    inboxes = [mp.Queue(STREAM_QUEUE_SIZE) for _ in range(JOBS_NB)]
+    outbox = mp.Queue()
+    sharder = Sharder(XDR_, JOBS_NB)
+    resumed = [[] for _ in inboxes]
+    watermark = None
+    if checkpoint is not None:
+        for xdr in checkpoint.xdrs:
+            resumed[sharder(xdr, len(xdr.messages))].append(xdr)
+        watermark = checkpoint.watermark
+    workers = [
+        mp.Process(
+            target=correlation_worker,
+            args=(
+                XDR_, inbox, outbox, l3_decoder, xdrs, keep_open, nb, reorder_window
+            ),
+        )
+        for nb, (inbox, xdrs) in enumerate(zip(inboxes, resumed))
+    ]
+    for worker in workers:
+        worker.start()
+    stats = Counter()
+    still_open = []
+    shards = [None] * len(workers)
+
+    def receive(timeout=None):
+        """Handles the output of the workers, waiting up to ``timeout``
+        seconds for some. Returns whether any came."""
+        try:
+            if timeout is None:
+                item = outbox.get_nowait()
+            else:
+                item = outbox.get(timeout=timeout)
+        except queue.Empty:
+            # workers exit with 0 once their output is queued
+            for nb, worker in enumerate(workers):
+                if worker.exitcode not in (None, 0):
+                    raise WorkerError(
+                        f"correlation worker {nb} exited with {worker.exitcode}"
+                    )
+            return False
+        if isinstance(item, dict):
+            if "error" in item:
+                raise item["error"] from WorkerError(item["traceback"])
+            stats.update(item["stats"])
+            still_open.extend(item["open"])
+            shards[item["shard"]["nb"]] = item["shard"]
+            return True
+        for xdr in item:
+            emit(xdr)
+        return True
+
+    def send(shard, item):
+        while True:
+            try:
+                inboxes[shard].put(item, timeout=WORKER_POLL)
+                break
+            except queue.Full:
+                # a worker that stopped reading may have failed
+                receive(WORKER_POLL)
+        while receive():
+            pass
+
+    try:
+        batches = [[] for _ in inboxes]
+        for msg in msgs:
+            stats["msgs"] += 1
+            if watermark is None or msg.ts > watermark:
+                watermark = msg.ts
+            shard = sharder(msg)
+            batches[shard].append(msg)
+            if len(batches[shard]) < STREAM_BATCH:
+                continue
+            send(shard, batches[shard])
+            batches[shard] = []
+        for shard, batch in enumerate(batches):
+            if batch:
+                send(shard, batch)
+            send(shard, watermark)
+        while None in shards:
+            receive(WORKER_POLL)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    for worker in workers:
+        worker.join()
+    report_shards(shards)
+    profiler.add_shards(shards)
+    if checkpoint is not None:
+        checkpoint.xdrs = still_open
+        checkpoint.watermark = watermark
+    return stats
+
+
+def read_messages(
+    in_file: pathlib.Path,
+    Message_,
+    l3: bool = False,
+    mapped: bool = False,
+    profiler=NULL_PROFILER,
+    prefilter=None,
+):
+    """Messages of a file. With a ``prefilter`` the file is mapped, so that
+    bodies are checked as bytes before being parsed."""
+    if mapped or prefilter is not None:
+        yield from MappedFile.open(in_file).messages(
+            Message_, l3=l3, keep_text=not mapped, prefilter=prefilter
+        )
+        return
+    if in_file.suffix == ".gz":
+        fl = gzip.open(in_file, "rt")
+    else:
+        fl = open(in_file, "r")
+    with fl:
+        # lines read, and decompressed, as the "read" stage
+        lines = profiler.iterate("read", fl)
+        while True:
+            msg = Message_()
+            found = msg.from_text(lines, l3=l3)
+            if msg.name is None:
+                # no header left
+                return
+            # messages without their cardinal field are skipped, as when mapped
+            if found:
+                yield msg
+
+
+def parse_files(
+    in_files,
+    Message_,
+    jobs=CPU_NB,
+    chunk_size=PARSE_CHUNK,
+    l3=False,
+    filters=None,
+):
+    """Parses files by byte ranges in a process pool. Yields (file, messages)
+    per range, in input order; a few ranges per process are parsed ahead.
+
+    Workers send back the fields and spans of the messages, see
+    ``MessageIndex``, which are made into messages over the mapping of the
+    file here: bodies are read from it on demand, as with ``--mmap``."""
+
+    def messages(source, future):
+        return list(future.result().messages(source, l3=l3))
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        pending = deque()
+        for in_file in in_files:
+            source = MappedFile.open(in_file)
+            for start, end in source.chunks(Message_.re_msg_nm, chunk_size):
+                future = executor.submit(
+                    index_chunk, source, Message_, start, end, l3, filters
+                )
+                pending.append((in_file, source, future))
+                if len(pending) >= jobs * PARSE_AHEAD:
+                    in_file_, source_, future = pending.popleft()
+                    yield in_file_, messages(source_, future)
+        while pending:
+            in_file, source, future = pending.popleft()
+            yield in_file, messages(source, future)
+
+
+def first_ts(in_file: pathlib.Path, Message_):
+    """Timestamp of the first message header of a file, None without any."""
+    opener = gzip.open if in_file.suffix == ".gz" else open
+    with opener(in_file, "rt") as fl:
+        for line in fl:
+            if Message_.bounds[0] in line:
+                mo = Message_.re_msg_nm.match(line)
+                if mo:
+                    return Message_.parse_ts(mo.group(2))
+    return None
+
+
+def time_order(in_files, Message_) -> List[pathlib.Path]:
+    """Files in the order of their first timestamp, those without messages
+    last. Times of day start after the largest gap between the first times,
+    so that files past midnight come after those of the evening."""
+    firsts = [(first_ts(in_file, Message_), in_file) for in_file in in_files]
+    timed = sorted(
+        (item for item in firsts if item[0] is not None), key=lambda item: item[0]
+    )
+    if Message_.time_of_day and len(timed) > 1:
+        gaps = [second[0] - first[0] for first, second in zip(timed, timed[1:])]
+        largest = max(range(len(gaps)), key=gaps.__getitem__)
+        if gaps[largest] > timed[0][0] + DAY_MS - timed[-1][0]:
+            timed = timed[largest + 1 :] + timed[: largest + 1]
+    return [in_file for _, in_file in timed] + [
+        in_file for ts, in_file in firsts if ts is None
+    ]
 
 
 def load_dlt(csv_file):
@@ -110,21 +456,196 @@ def parse_argsuments(args):
     parser = argparse.ArgumentParser(description="correlate text file")
     for key in ("crnti", "enbid", "trsr", "tmsi", "ueid", "rncmodid", "scenario"):
         parser.add_argument(f"--{key}", dest=key, type=int, action="store")
-    parser.add_argument("--file", nargs="+", dest="file", action="store", required=True)
+    parser.add_argument("--file", nargs="+", dest="file", action="store", default=[])
     parser.add_argument("--gci", dest="gci", type=int, action="store")
     parser.add_argument("--headers", dest="headers", action="store_true")
     parser.add_argument("--sorted", dest="sorted", action="store_true")
     parser.add_argument("--correlate", dest="correlate", action="store_true")
+    parser.add_argument(
+        "--stream",
+        dest="stream",
+        action="store_true",
+        help="correlate while parsing and print XDRs as soon as they close",
+    )
+    parser.add_argument(
+        "--mmap",
+        dest="mmap",
+        action="store_true",
+        help="map input files and keep only body offsets in memory",
+    )
+    parser.add_argument(
+        "--parse-jobs",
+        dest="parse_jobs",
+        type=int,
+        action="store",
+        default=CPU_NB,
+        help="processes parsing input files by chunks, 1 parses in place;"
+        " messages parsed by chunks keep only body offsets, as with --mmap",
+    )
+    parser.add_argument(
+        "--parse-cache",
+        dest="parse_cache",
+        nargs="?",
+        const="",
+        action="store",
+        metavar="DIR",
+        help="keep the parsed fields of each input file in a sidecar file, next"
+        " to it or in DIR, and read them from there on later runs; messages"
+        " are then read from mapped files as with --mmap",
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        action="store",
+        choices=("python", "numpy"),
+        default="python",
+        help="correlation engine of the batch mode, numpy needs numpy installed",
+    )
     parser.add_argument("--l3", dest="l3", action="store_true")
     parser.add_argument("--fulldecode", dest="fulldecode", action="store_true")
+    parser.add_argument(
+        "--l3-lazy",
+        dest="l3_lazy",
+        action="store_true",
+        help="decode the L3 of an XDR only when it is printed or stored; with"
+        " --tmsi, only the messages the TMSI is read from are decoded first",
+    )
+    parser.add_argument(
+        "--decoder",
+        dest="decoder",
+        action="store",
+        help="command used instead of tshark, {dlt} is replaced by the dissector",
+    )
+    parser.add_argument(
+        "--l3-cache",
+        dest="l3_cache",
+        action="store",
+        help="sqlite file keeping L3 decode results across workers and runs",
+    )
+    parser.add_argument(
+        "--l3-cache-mb",
+        dest="l3_cache_mb",
+        type=int,
+        action="store",
+        default=256,
+        help="memory for L3 decode results per process, in MB",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        action="store",
+        help="resume the sessions left open in this file by the previous run"
+        " and save the ones still open at the end; files are taken in the"
+        " order of their first timestamp, files already processed are skipped",
+    )
+    parser.add_argument(
+        "--finalize",
+        dest="finalize",
+        action="store_true",
+        help="with --checkpoint, end the series: the sessions still open at"
+        " the end are output and the checkpoint file is removed; --file may"
+        " then be left out",
+    )
+    parser.add_argument(
+        "--reorder-window",
+        dest="reorder_window",
+        type=float,
+        default=REORDER_WINDOW,
+        help="seconds past T1 an XDR waits for late messages (default:"
+        f" {REORDER_WINDOW}); with --stream, a message arriving later than"
+        " that behind the stream time starts a new XDR, whereas without it"
+        " every message still joins its XDR; with --checkpoint, it also sets"
+        " the sessions kept open for the next run",
+    )
+    parser.add_argument(
+        "--store",
+        dest="store",
+        action="store",
+        help="add the XDRs of this run to this sqlite file, see the query command",
+    )
     parser.add_argument("--stat", dest="stat", action="store_true")
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store",
+        help="write time, CPU, items and peak memory of each stage to this"
+        " JSON file, with folded stacks for flame graphs",
+    )
+    parser.add_argument(
+        "-g", dest="tech", action="store", choices=("3G", "4G"), default="4G"
+    )
+    parsed = parser.parse_args(args)
+    if parsed.engine == "numpy" and np is None:
+        parser.error("--engine numpy: numpy is not installed")
+    if parsed.engine == "numpy" and parsed.stream:
+        parser.error("--engine numpy works on whole shards, not with --stream")
+    if parsed.l3_lazy and parsed.stream:
+        parser.error("--l3-lazy decodes at output time, not with --stream")
+    if parsed.finalize and not parsed.checkpoint:
+        parser.error("--finalize ends the series of a --checkpoint")
+    if not parsed.file and not parsed.finalize:
+        parser.error("the following arguments are required: --file")
+    return parsed
+
+
+def parse_query_arguments(args):
+    parser = argparse.ArgumentParser(
+        prog="decoded_corr.py query",
+        description="find XDRs in a store written with --store",
+    )
+    parser.add_argument("store", help="sqlite file written with --store")
+    for key in ("tmsi", "gci", "enbid", "trsr", "crnti", "rncmodid", "ueid"):
+        parser.add_argument(f"--{key}", dest=key, type=int, action="store")
+    parser.add_argument("--scenario", dest="scenario", type=int, action="store")
+    parser.add_argument(
+        "--from",
+        dest="ts_from",
+        action="store",
+        help="XDRs ending at or after this time, HH:MM:SS[.fff] for 4G (past"
+        " 24:00:00 after the midnight of a run), as in the traces for 3G",
+    )
+    parser.add_argument(
+        "--to", dest="ts_to", action="store", help="XDRs starting at or before"
+    )
     parser.add_argument(
         "-g", dest="tech", action="store", choices=("3G", "4G"), default="4G"
     )
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    Message_ = Message4G if parsed.tech == "4G" else Message3G
+    for key in ("ts_from", "ts_to"):
+        value = getattr(parsed, key)
+        if value is None:
+            continue
+        try:
+            setattr(parsed, key, Message_.parse_ts(value))
+        except ValueError:
+            parser.error(f"{value}: not a {parsed.tech} time")
+    return parsed
+
+
+def query(args):
+    parsed = parse_query_arguments(args)
+    XDR_ = XDR4G if parsed.tech == "4G" else XDR3G
+    assert pathlib.Path(parsed.store).exists()
+    filters = {
+        key: getattr(parsed, key)
+        for key in ("tmsi", "gci", "enbid", "trsr", "crnti", "rncmodid", "ueid")
+    }
+    filters["scenario"] = parsed.scenario
+    xdr_nb = 0
+    with XDRStore(parsed.store) as store:
+        for xdr_id, pos, text in store.query(
+            XDR_, filters, parsed.ts_from, parsed.ts_to
+        ):
+            print(xdr_id, pos, text)
+            xdr_nb += 1
+    print("Nb of XDRs: ", xdr_nb)
 
 
 def main(args):
+    if args and args[0] == "query":
+        query(args[1:])
+        return
     parsed = parse_argsuments(args)
     if parsed.tech == "4G":
         XDR_ = XDR4G
@@ -132,107 +653,317 @@ def main(args):
     else:
         XDR_ = XDR3G
         Message_ = Message3G
-    parse_ts = XDR_.parse_ts
 
     parsed.l3 = parsed.l3 or parsed.fulldecode
+    parsed.correlate = parsed.correlate or parsed.stream or bool(parsed.checkpoint)
     if parsed.l3:
         dlt_file = pathlib.Path(DLT_FILE)
         assert dlt_file.exists()
         load_dlt(dlt_file)
+    filters = {
+        key: getattr(parsed, key)
+        for key in ("gci", "enbid", "trsr", "crnti", "rncmodid", "ueid")
+    }
     quenue = [[] for x in range(JOBS_NB)]
-    fl_nb = len(parsed.file) + 1
     results = []
+    profiler = Profiler() if parsed.profile else NULL_PROFILER
     scenarios = XDR_scenario()
-    scenarios.load_persistent()
-    for in_file in parsed.file:
-        fl_nb -= 1
-        msg = Message_()
-        print(in_file, fl_nb, file=sys.stderr)
-        in_file = pathlib.Path(in_file)
-        assert in_file.exists()
-        if in_file.suffix == ".gz":
-            fl = iter(gzip.open(in_file, "rt").readlines())
+    scenario_nb = profiler.wrap("scenarios", scenarios.scenario_nb)
+    stats = defaultdict(int)
+    counters = Counter()
+    l3_cache = None
+    if parsed.l3:
+        l3_cache = L3Cache(parsed.l3_cache_mb * 2 ** 20, path=parsed.l3_cache)
+
+    store = None
+    if parsed.store and parsed.correlate:
+        store = XDRStore(parsed.store)
+        store.start_run([str(pathlib.Path(name).resolve()) for name in parsed.file])
+
+    checkpoint = None
+    if parsed.checkpoint:
+        checkpoint = Checkpoint.load(parsed.checkpoint, XDR_)
+    clock = DayClock() if Message_.time_of_day else None
+    if checkpoint is not None and checkpoint.clock is not None:
+        clock = checkpoint.clock
+
+    def input_files():
+        in_files = [pathlib.Path(in_file) for in_file in parsed.file]
+        for in_file in in_files:
+            assert in_file.exists()
+        fl_nb = len(in_files) + 1
+        # sessions carry over from one file to the next in time order
+        for in_file in time_order(in_files, Message_):
+            fl_nb -= 1
+            print(in_file, fl_nb, file=sys.stderr)
+            if checkpoint is not None:
+                if str(in_file.resolve()) in checkpoint.files:
+                    print(in_file, "already processed", file=sys.stderr)
+                    continue
+                checkpoint.files.append(str(in_file.resolve()))
+            yield in_file
+
+    def input_messages():
+        """Messages of all inputs, in order, filtered and with their day set."""
+        prefilter = Message_.prefilter(filters)
+        if parsed.parse_cache is not None:
+            # filtered on the index columns, before messages are made
+            msgs = profiler.iterate(
+                "parse",
+                (
+                    msg
+                    for in_file in input_files()
+                    for msg in MessageIndex.open(
+                        in_file,
+                        Message_,
+                        parsed.parse_cache,
+                        jobs=parsed.parse_jobs,
+                        chunk_size=PARSE_CHUNK,
+                    ).messages(MappedFile.open(in_file), l3=parsed.l3, filters=filters)
+                ),
+            )
+        elif parsed.parse_jobs > 1:
+            chunks = parse_files(
+                input_files(),
+                Message_,
+                jobs=parsed.parse_jobs,
+                l3=parsed.l3,
+                filters=filters,
+            )
+            # parsed and filtered by the workers, the wait for them here
+            msgs = profiler.iterate(
+                "parse", (msg for _, chunk in chunks for msg in chunk)
+            )
         else:
-            fl = open(in_file, "r")
-        msg.from_text(fl, l3=parsed.l3 or parsed.fulldecode)
-        while msg.cardinal_field_val is not None:
-            filtered = msg.matches(
-                gci=parsed.gci,
-                enbid=parsed.enbid,
-                trsr=parsed.trsr,
-                crnti=parsed.crnti,
-                rncmodid=parsed.rncmodid,
-                ueid=parsed.ueid,
+            msgs = profiler.iterate(
+                "filter",
+                (
+                    msg
+                    for in_file in input_files()
+                    for msg in profiler.iterate(
+                        "parse",
+                        read_messages(
+                            in_file,
+                            Message_,
+                            l3=parsed.l3,
+                            mapped=parsed.mmap,
+                            profiler=profiler,
+                            prefilter=prefilter,
+                        ),
+                    )
+                    if msg.matches(**filters)
+                ),
+            )
+        for msg in msgs:
+            if clock is not None:
+                msg.ts = clock(msg.ts)
+            yield msg
+
+    if parsed.stream:
+
+        def emit(xdr):
+            pos = scenario_nb(xdr.get_msg_descr())
+            if parsed.scenario and pos != parsed.scenario:
+                return
+            if (parsed.tmsi and parsed.tmsi == xdr.tmsi) or (not parsed.tmsi):
+                print(sum(stats.values()), pos, xdr, flush=True)
+            if store is not None:
+                store.add(xdr, pos)
+            stats[pos] += 1
+
+        emit = profiler.wrap("output", emit)
+        with profiler.stage("stream") as stage:
+            counters = correlate_stream(
+                input_messages(),
+                XDR_,
+                emit,
+                l3_decoder=l3_decoder(parsed, l3_cache),
+                checkpoint=checkpoint,
+                profiler=profiler,
+                finalize=parsed.finalize,
+                reorder_window=parsed.reorder_window,
             )
-            if filtered:
-                if parsed.correlate:
-                    quenue[msg.cardinal_field_val % JOBS_NB].append(msg)
-                else:
+            stage.items = msg_nb = counters["msgs"]
+    else:
+        # all files go through the same shards, sessions span file boundaries
+        sharder = Sharder(XDR_, JOBS_NB)
+        # rows of the resumed XDRs, which come first in their shard
+        open_rows = [[] for _ in quenue]
+        watermark = None
+        resumed = []
+        if checkpoint is not None:
+            resumed = checkpoint.xdrs
+            checkpoint.xdrs = []
+            watermark = checkpoint.watermark
+        msg_nb = 0
+        # with --parse-cache, the columns of the sidecars go to the workers
+        # as they are, messages are only made for the XDRs
+        cached = None
+        with profiler.stage("input") as stage:
+            if parsed.correlate and parsed.parse_cache is not None:
+                cached = MessageRows(Message_)
+                for in_file in input_files():
+                    index = MessageIndex.open(
+                        in_file,
+                        Message_,
+                        parsed.parse_cache,
+                        jobs=parsed.parse_jobs,
+                        chunk_size=PARSE_CHUNK,
+                    )
+                    cached.add(in_file, index, filters, clock)
+                if len(cached):
+                    last_ts = max(cached.columns.ts)
+                    if watermark is None or last_ts > watermark:
+                        watermark = last_ts
+                stage.items = len(cached)
+            else:
+                for msg in input_messages():
                     results.append(msg)
-                ts = msg.timestamp
-                parse_ts(ts)
-            msg = Message_()
-            msg.from_text(fl, l3=parsed.l3 or parsed.fulldecode)
+                    if watermark is None or msg.ts > watermark:
+                        watermark = msg.ts
+                stage.items = len(results)
 
         if parsed.correlate:
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                for xdrs in executor.map(correlate, quenue):
-                    if parsed.scenario:
-                        xdrs = [
-                            xdr
-                            for xdr in xdrs
-                            if scenarios.scenario_nb(xdr.get_msg_descr())
-                            == parsed.scenario
-                        ]
-                    XDRs.extend(xdrs)
-                    # print(f"{fl_nb} {msg_nb} left")
-                    # msg_nb -= 1
-            func = None
-            if parsed.fulldecode:
-                func = decode_l3_full
-            elif parsed.l3:
-                func = decode_l3_short
-            else:
-                continue
-            msg_nb = sum([len(x) for x in quenue])
-
-            for xdr in XDRs:
-                with concurrent.futures.ProcessPoolExecutor(
-                    max_workers=JOBS_NB
-                ) as executor:
-                    for msg, meta in zip(
-                        xdr.messages, executor.map(func, xdr.messages)
-                    ):
-                        if meta is not None:
-                            xdr.add_meta(f"{msg.name}: {meta}")
-                msg_nb -= len(xdr.messages)
-                print(
-                    f"l3. {len(xdr.messages)} msgs in xdr. {msg_nb} msgs in curr file left",
-                    file=sys.stderr,
+            msg_nb = len(results) if cached is None else len(cached)
+            # rows of ``cached`` of each shard, after its messages
+            cached_rows = [[] for _ in quenue]
+            with profiler.stage("shard", msg_nb):
+                # groups of messages one XDR may link are bound once all are
+                # known, the largest first
+                routes = sharder.split(
+                    [xdr.messages for xdr in resumed] + [[msg] for msg in results],
+                    None if cached is None else cached.columns,
                 )
-    if parsed.correlate:
-        for idx, xdr in enumerate(XDRs):
-            ptrn = xdr.get_msg_descr()
-            if (parsed.tmsi and parsed.tmsi == xdr.tmsi) or (not parsed.tmsi):
-                print(idx, scenarios.scenario_nb(ptrn), xdr)
-    else:
-        if parsed.sorted:
-            results = sorted(results)
-        for msg in results:
-            if parsed.headers:
-                print(msg)
+                for xdr, shard in zip(resumed, routes):
+                    row = len(quenue[shard])
+                    open_rows[shard].append(list(range(row, row + len(xdr.messages))))
+                    quenue[shard].extend(xdr.messages)
+                for msg, shard in zip(results, routes[len(resumed) :]):
+                    quenue[shard].append(msg)
+                if cached is not None:
+                    for row, shard in enumerate(routes[len(resumed) :]):
+                        cached_rows[shard].append(row)
+                results = []
+
+            def shard_columns(shard):
+                columns = MessageColumns(Message_, quenue[shard])
+                if cached is not None:
+                    columns.extend(cached.columns.take(cached_rows[shard]))
+                return columns
+
+            if checkpoint is not None:
+                checkpoint.watermark = watermark
+            shards = []
+            with profiler.stage("correlate", msg_nb):
+                with concurrent.futures.ProcessPoolExecutor() as executor:
+                    # only the fields correlation needs go to the workers
+                    for nb, (xdrs, still_open, shard) in enumerate(
+                        executor.map(
+                            correlate,
+                            itertools.repeat(XDR_),
+                            map(shard_columns, range(len(quenue))),
+                            open_rows,
+                            itertools.repeat(watermark),
+                            itertools.repeat(
+                                checkpoint is not None and not parsed.finalize
+                            ),
+                            itertools.repeat(parsed.engine),
+                            itertools.repeat(parsed.reorder_window),
+                        ),
+                    ):
+                        shards.append(shard)
+                        msgs = quenue[nb]
+                        if cached is not None:
+                            msgs = msgs + cached.messages(cached_rows[nb], parsed.l3)
+                        xdrs = [build_xdr(XDR_, msgs, rows) for rows in xdrs]
+                        if checkpoint is not None:
+                            checkpoint.xdrs.extend(
+                                build_xdr(XDR_, msgs, rows) for rows in still_open
+                            )
+                        if parsed.scenario:
+                            xdrs = [
+                                xdr
+                                for xdr in xdrs
+                                if scenario_nb(xdr.get_msg_descr())
+                                == parsed.scenario
+                            ]
+                        XDRs.extend(xdrs)
+                report_shards(shards)
+            profiler.add_shards(shards)
+        decoder = None
+        if parsed.correlate and parsed.l3:
+            decoder = l3_decoder(parsed, l3_cache)()
+            with profiler.stage("l3") as stage:
+                if not parsed.l3_lazy:
+                    decode_xdrs(decoder, XDRs, counters)
+                elif parsed.tmsi:
+                    # what --tmsi is checked on, the rest once printed
+                    decode_xdrs(decoder, XDRs, counters, XDR_.meta_names())
+                stage.items = counters["l3_msgs"]
+        with profiler.stage("output", len(XDRs) or len(results)):
+            if parsed.correlate:
+                for start in range(0, len(XDRs), OUTPUT_BATCH):
+                    xdrs = XDRs[start : start + OUTPUT_BATCH]
+                    shown = [
+                        (parsed.tmsi and parsed.tmsi == xdr.tmsi) or (not parsed.tmsi)
+                        for xdr in xdrs
+                    ]
+                    if decoder is not None and parsed.l3_lazy:
+                        with profiler.stage("l3"):
+                            decode_xdrs(
+                                decoder,
+                                [
+                                    xdr
+                                    for xdr, show in zip(xdrs, shown)
+                                    if show or store is not None
+                                ],
+                                counters,
+                            )
+                    for idx, xdr, show in zip(itertools.count(start), xdrs, shown):
+                        pos = scenario_nb(xdr.get_msg_descr())
+                        if show:
+                            print(idx, pos, xdr)
+                        if store is not None:
+                            store.add(xdr, pos)
+                        stats[pos] += 1
             else:
-                print(msg.BODY)
+                if parsed.sorted:
+                    results = sorted(results)
+                for msg in results:
+                    if parsed.headers:
+                        print(msg)
+                    else:
+                        print(msg.body)
+        if decoder is not None:
+            decoder.close()
+            counters.update(l3_cache.stats())
+    if counters["l3_msgs"]:
+        print(
+            f"l3. {counters['l3_msgs']} msgs decoded in {counters['l3_time']:.1f}s,"
+            f" {counters['l3_msgs'] / counters['l3_time']:.0f} msgs/sec",
+            file=sys.stderr,
+        )
     if parsed.stat:
-        stats = defaultdict(int)
-        for xdr in XDRs:
-            ptrn = xdr.get_msg_descr()
-            pos = scenarios.scenario_nb(ptrn)
-            stats[pos] += 1
         for ptrn in sorted(stats, key=stats.get, reverse=True):
             print(f"pattern: {ptrn}\tnumber: {stats[ptrn]}")
-    print("Nb of messages: ", sum([len(x) for x in quenue]))
-    scenarios.save_persistent()
+        if l3_cache is not None:
+            print(
+                f"l3 cache hits: {counters['l3_cache_hits']}"
+                f"\tmisses: {counters['l3_cache_misses']}"
+            )
+    if store is not None:
+        store.close()
+    if checkpoint is not None and parsed.finalize:
+        if os.path.exists(parsed.checkpoint):
+            os.remove(parsed.checkpoint)
+        print("series finalized, checkpoint removed", file=sys.stderr)
+    elif checkpoint is not None:
+        checkpoint.clock = clock
+        checkpoint.save(parsed.checkpoint)
+        print(f"open sessions kept: {len(checkpoint.xdrs)}", file=sys.stderr)
+    if parsed.profile:
+        profiler.save(parsed.profile)
+    print("Nb of messages: ", msg_nb)
 
 
 if __name__ == "__main__":